@@ -0,0 +1,299 @@
+"""
+CPU benchmarks of the data pipeline, TransformerLayer, decoding and tokenization.
+
+    python bench.py --output bench_output.json
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json  # exits 1 on a regression
+
+Metrics ending in `_per_sec` are better when higher, metrics ending in `_ms` or `_mb` are
+better when lower; a metric is a regression when it is worse than the baseline by more than
+`--tolerance`. Timings depend on the machine, so a baseline is saved and compared on the
+same machine and is not part of the repository.
+
+The attention benchmark times a TransformerLayer train step with full and with chunked
+attention as the attended length grows, each length in a fresh process so that its peak
+memory can be read from the process:
+
+    python bench.py --skip-layer --attention-lengths 1024,2048,4096,8192
+
+These lengths are synthetic; the model attends over `arrayDimension` rows. The layer of the
+configured model (`arrayDimension` rows of `dimension`, `attentionChunk` rows per chunk) is
+timed too, as `attention_full_model_*` and `attention_chunked_model_*`, which shows whether
+chunking helps the model as it is configured.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from config import cfg
+from embedding_table import EmbeddingTable, write_embedding_table
+from input_workers import ParallelBatchLoader
+from sampler import WindowSampler, assemble_batch
+from vector_index import VectorIndex
+
+DEFAULT_CORPUS = './data/gutenberg.org_files_35_35-0.txt'
+# (sequenceSize, dimension, arrayDimension) of the TransformerLayer step benchmark
+LAYER_SIZES = [(128, 128, 8), (512, 512, 8), (512, 512, 32)]
+
+
+def measure(fn, repeats=5, warmup=1):
+    """Median wall time of `fn()` in seconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def synthetic_table(table_path, vocab_size, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    write_embedding_table(table_path, np.arange(vocab_size), rng.normal(size=(vocab_size, dim)).astype(np.float32))
+    return EmbeddingTable(table_path)
+
+
+def bench_input_pipeline(tokens, table, sequence_size, predict_steps, batch_size, steps=8, input_workers=0, tmp_dir=None):
+    """
+    Batches/sec of the sampler over consecutive windows of one book, over shuffled windows
+    of several books and of its worker processes.
+    """
+    results = {}
+    book_vectors = table.gather(tokens)
+    results['convert_tokens_per_sec'] = len(tokens) / measure(lambda: table.gather(tokens))
+
+    def sampled(sampler, books, num_steps):
+        for step, book_ids, starts in sampler.iter_epoch(0):
+            if step == num_steps:
+                break
+            assemble_batch(books, book_ids, starts, sequence_size, predict_steps)
+
+    # windows starting at consecutive tokens, the access pattern of a single book
+    sequential = WindowSampler([len(book_vectors)], sequence_size, predict_steps, batch_size, shuffle=False)
+    num_steps = min(steps, sequential.steps_per_epoch)
+    if num_steps:
+        results['sequential_batches_per_sec'] = num_steps / measure(
+            lambda: sampled(sequential, [book_vectors], num_steps))
+
+    books = np.array_split(book_vectors, 8)
+    sampler = WindowSampler([len(b) for b in books], sequence_size, predict_steps, batch_size, stride=8, seed=0)
+    num_steps = min(steps, sampler.steps_per_epoch)
+    if num_steps:
+        results['sampler_batches_per_sec'] = num_steps / measure(lambda: sampled(sampler, books, num_steps))
+
+    if num_steps and input_workers and tmp_dir:
+        paths = []
+        for n, book in enumerate(books):
+            paths.append(os.path.join(tmp_dir, f'book_{n}.npy'))
+            np.save(paths[-1], book)
+        loader = ParallelBatchLoader(paths, sampler, input_workers)
+        batches = iter(loader)
+        try:
+            # copy every batch out of its slot, as converting it to a tensor would
+            results['parallel_batches_per_sec'] = num_steps / measure(
+                lambda: [np.array(xs) for xs, _ in itertools.islice(batches, num_steps)])
+        finally:
+            loader.close()
+    return results
+
+
+def bench_layer(sizes, batch_size, repeats):
+    """Forward+backward step time of a Conv1D + two TransformerLayer stack, original and fast path."""
+    import tensorflow as tf
+    from transformer import TransformerLayer
+
+    results = {}
+    for sequence_size, dimension, array_dimension in sizes:
+        x = tf.random.normal([batch_size, sequence_size, array_dimension])
+        for fast in (False, True):
+            inputs = tf.keras.layers.Input(shape=(sequence_size, array_dimension))
+            h = tf.keras.layers.Permute((2, 1))(inputs)
+            h = tf.keras.layers.Conv1D(filters=dimension, kernel_size=1)(h)
+            h = TransformerLayer(depth=dimension, num_heads=4, pad_size=array_dimension, fast=fast)(h)
+            h = TransformerLayer(depth=sequence_size, num_heads=4, pad_size=array_dimension, fast=fast)(h)
+            model = tf.keras.Model(inputs, tf.keras.layers.Permute((2, 1))(h))
+
+            @tf.function
+            def step():
+                with tf.GradientTape() as tape:
+                    loss = tf.reduce_mean(tf.square(model(x, training=True) - x))
+                return tape.gradient(loss, model.trainable_variables)
+
+            name = f"layer_{sequence_size}_{dimension}_{array_dimension}_{'fast' if fast else 'original'}"
+            results[f'{name}_step_ms'] = measure(step, repeats) * 1000.0
+    return results
+
+
+def _rss_kb():
+    """Resident memory of this process in KB; the peak so far where /proc is not available."""
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _attention_step(attention, length, batch_size, depth, chunk_size, repeats):
+    """Step time in ms and peak memory in MB above the idle process of one TransformerLayer train step."""
+    import tensorflow as tf
+    from transformer import TransformerLayer
+
+    x = tf.random.normal([batch_size, length, depth])
+    layer = TransformerLayer(depth=depth, num_heads=4, pad_size=length, fast=True, attention=attention,
+                             chunk_size=chunk_size)
+    layer.build(x.shape)
+    idle = _rss_kb()
+
+    @tf.function
+    def step():
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.square(layer(x, training=True)))
+        return tape.gradient(loss, layer.trainable_variables)
+
+    step_ms = measure(step, repeats) * 1000.0
+    # ru_maxrss is in KB on Linux
+    return step_ms, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - idle) / 1024.0
+
+
+def bench_attention(lengths, batch_size, depth, chunk_size, repeats, label=None):
+    """
+    Step time and peak memory of full and chunked attention over `lengths` attended rows;
+    the metrics are named after `label` instead of the length when it is given.
+    """
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for length in lengths:
+        for attention in ('full', 'chunked'):
+            name = f'attention_{attention}_{label or length}'
+            # an executor, not a Pool, so a worker killed for running out of memory raises
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                try:
+                    step_ms, peak_mb = executor.submit(
+                        _attention_step, attention, length, batch_size, depth, chunk_size, repeats).result()
+                except Exception as e:
+                    # a full attention matrix that does not fit is a result too
+                    print(f'{name} failed: {e!r}')
+                    continue
+            results[f'{name}_step_ms'] = step_ms
+            results[f'{name}_peak_mb'] = peak_mb
+    return results
+
+
+def bench_decode(table, num_vectors, seed=0):
+    """Tokens/sec of decoding noisy table vectors with every VectorIndex mode."""
+    rng = np.random.default_rng(seed)
+    token_ids = table.token_ids
+    queries = np.asarray(table.vectors)[rng.choice(token_ids, size=num_vectors)]
+    queries = queries + rng.normal(scale=0.01, size=queries.shape).astype(np.float32)
+    results = {}
+    for name, kwargs in [('exact', {}), ('ivf', {'mode': 'ivf'}), ('exact_int8', {'quantize': True})]:
+        index = VectorIndex.from_table(table, **kwargs)
+        results[f'decode_{name}_tokens_per_sec'] = num_vectors / measure(lambda: index.decode(queries), repeats=3)
+    return results
+
+
+def bench_tokenize(text):
+    """Characters/sec of build_tokens.process_text."""
+    from build_tokens import process_text
+    return {'tokenize_chars_per_sec': len(text) / measure(lambda: process_text(text), repeats=3)}
+
+
+def compare(results, baseline, tolerance):
+    """Names and relative changes of the metrics that are worse than `baseline` by more than `tolerance`."""
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline or not baseline[name]:
+            continue
+        change = (value - baseline[name]) / baseline[name]
+        if (name.endswith('_per_sec') and change < -tolerance) or (name.endswith(('_ms', '_mb')) and change > tolerance):
+            regressions.append((name, change))
+    return regressions
+
+
+def run_benchmarks(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        table = synthetic_table(os.path.join(tmp, 'vec.bin'), args.vocab_size, args.dim)
+        rng = np.random.default_rng(0)
+
+        corpora = {'synthetic': rng.integers(0, args.vocab_size, size=args.synthetic_tokens)}
+        if args.corpus and os.path.exists(args.corpus):
+            with open(args.corpus, 'r', encoding='utf-8') as f:
+                text = f.read()
+            results.update(bench_tokenize(text))
+            from build_tokens import encoding
+            corpora['corpus'] = np.asarray(encoding.encode(text), dtype=np.int64) % args.vocab_size
+
+        for corpus_name, tokens in corpora.items():
+            pipeline = bench_input_pipeline(tokens, table, args.sequence_size, args.dim, args.batch_size,
+                                            input_workers=args.input_workers, tmp_dir=tmp)
+            results.update({f'{corpus_name}_{name}': value for name, value in pipeline.items()})
+
+        results.update(bench_decode(table, args.decode_vectors))
+    if not args.skip_layer:
+        results.update(bench_layer(LAYER_SIZES, args.layer_batch_size, args.repeats))
+    if args.attention_lengths:
+        lengths = [int(length) for length in args.attention_lengths.split(',')]
+        results.update(bench_attention(lengths, args.attention_batch_size, args.attention_depth, args.attention_chunk,
+                                       args.repeats))
+        results.update(bench_attention([cfg['arrayDimension']], args.attention_batch_size, cfg['dimension'],
+                                       cfg['attentionChunk'], args.repeats, label='model'))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the data pipeline, layer and decoding hot paths on CPU.')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--synthetic-tokens', type=int, default=1_000_000)
+    parser.add_argument('--vocab-size', type=int, default=100_000)
+    parser.add_argument('--dim', type=int, default=8, help='embedding dimension, also predictSteps')
+    parser.add_argument('--sequence-size', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--input-workers', type=int, default=4, help='ParallelBatchLoader processes, 0 skips it')
+    parser.add_argument('--layer-batch-size', type=int, default=32)
+    parser.add_argument('--decode-vectors', type=int, default=65536)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--skip-layer', action='store_true')
+    parser.add_argument('--attention-lengths', default='512,1024,2048,4096',
+                        help='comma separated attended lengths of the attention benchmark, empty skips it')
+    parser.add_argument('--attention-batch-size', type=int, default=2)
+    parser.add_argument('--attention-depth', type=int, default=64)
+    parser.add_argument('--attention-chunk', type=int, default=256)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='compare against this results file')
+    parser.add_argument('--save-baseline', help='also write the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args)
+    report = {'machine': platform.machine(), 'python': platform.python_version(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    for name, value in sorted(results.items()):
+        print(f'{name}: {value:.2f}')
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or '.', exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, change in regressions:
+            print(f'REGRESSION {name}: {change * 100:+.1f}% vs baseline')
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,230 @@
 import os
 import fasttext
+import numpy as np
 import tiktoken
 
+from dedup import dedup_store, duplicate_books, write_report
+from embedding_table import EmbeddingTable, load_vec_file, write_embedding_table
+from token_store import ShardWriter, TokenStore, TOKEN_DTYPE, compact_store, content_hash, list_books
+from vocab import save_vocab_table
+
 
 dim = 8
 
 # Initialize the encoding
 encoding = tiktoken.encoding_for_model("gpt-4")
 
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# Characters encoded per call when streaming a file; bounds the memory of a worker
+CHUNK_CHARS = 4 * 1024 * 1024
+# Tokens formatted per write when producing the fastText text
+WRITE_TOKENS = 1024 * 1024
+# Mean relative move of the known tokens during an incremental update above which a full retrain is suggested
+DRIFT_WARNING = 0.25
 
-def parallel_process_file(file_path):
+def process_text(text):
+    encoded_tokens = encoding.encode(text)
+    return ' '.join(map(str, encoded_tokens))
+
+def iter_text_chunks(in_f, chunk_chars=CHUNK_CHARS):
     """
-    Function to read and process a file. This function will be run in parallel.
+    Yield pieces of an open text file, cut right after a newline that starts a new word,
+    so encoding the pieces one by one gives the same tokens as encoding the whole file.
     """
-    with open(file_path, 'r', encoding='utf-8') as in_f:
-        text = in_f.read()
-        encoded_text = process_text(text)
-        return encoded_text
+    carry = ''
+    while True:
+        data = in_f.read(chunk_chars)
+        if not data:
+            break
+        text = carry + data
+        cut = len(text)
+        while cut > 0:
+            cut = text.rfind('\n', 0, cut)
+            if cut >= 0 and cut + 1 < len(text) and not text[cut + 1].isspace():
+                break
+        if cut <= 0:
+            carry = text
+            continue
+        yield text[:cut + 1]
+        carry = text[cut + 1:]
+    if carry:
+        yield carry
 
-def parallel_digest_data(directory, output_file, max_workers=None):
+def encode_file_to_part(file_path, part_path, chunk_chars=CHUNK_CHARS):
     """
-    Process text files in parallel.
-    
+    Tokenize one file chunk by chunk into a raw uint32 file. Runs in worker processes.
+    """
+    with open(file_path, 'r', encoding='utf-8') as in_f, open(part_path, 'wb') as out_f:
+        for chunk in iter_text_chunks(in_f, chunk_chars):
+            out_f.write(np.array(encoding.encode(chunk), dtype=TOKEN_DTYPE).tobytes())
+    return part_path
+
+def write_tokens_text(out_f, tokens):
+    """
+    Append tokens as space separated decimal ids, a bounded slice at a time.
+    """
+    for start in range(0, len(tokens), WRITE_TOKENS):
+        out_f.write(' '.join(map(str, tokens[start:start + WRITE_TOKENS].tolist())))
+        out_f.write(' ')
+
+def write_base_from_store(store, output_file, books=None):
+    """
+    Write the fastText training text from the token store without tokenizing again,
+    leaving out the spans removed by deduplication.
+    """
+    with open(output_file, 'w', encoding='utf-8') as out_f:
+        for book in books if books is not None else sorted(store.books):
+            write_tokens_text(out_f, store.get_kept(book))
+
+def stream_digest_data(directory, output_file, store_dir, max_workers=None, max_in_flight=None):
+    """
+    Tokenize changed books in parallel and write each one as soon as its worker finishes.
+
+    Every finished book is appended to a token shard and to the fastText text, then the
+    store index is saved, so at most `max_in_flight` books are held by workers at any time
+    and an interrupted run resumes with the books it had not finished. Books that are
+    byte-identical to an earlier book are recorded as duplicates and not tokenized.
+
     Args:
     - directory (str): Path to the directory containing text files.
-    - output_file (str): Path to the output file where processed data will be written.
+    - output_file (str): Path to the fastText text file.
+    - store_dir (str): Directory of the token store.
     - max_workers (int, optional): Maximum number of worker processes. If None, it will use as many as the machine has CPUs.
+    - max_in_flight (int, optional): Maximum number of books submitted but not yet written. Defaults to 2 * max_workers.
     """
-    # Clean (or clear the contents of) the output_file
-    with open(output_file, 'w', encoding='utf-8') as out_f:
-        pass
-    # Get list of text files in the directory
-    txt_files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.txt')]
-    
-    all_encoded_texts = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        for idx, encoded_text in enumerate(executor.map(parallel_process_file, txt_files), 1):
-            all_encoded_texts.append(encoded_text)
-            print(f"Processed file {idx} of {len(txt_files)}")
-    
-    # Write the processed text to the output file
-    with open(output_file, 'w', encoding='utf-8') as out_f:
-        out_f.write(" ".join(all_encoded_texts))
+    os.makedirs(store_dir, exist_ok=True)
+    store = TokenStore(store_dir)
+    books = list_books(directory)
+    hashes = {book: content_hash(os.path.join(directory, book)) for book in books}
+    duplicates = duplicate_books(books, hashes)
+    store.index['duplicates'] = duplicates
+    books = [book for book in books if book not in duplicates]
+    changed = [book for book in books if store.books.get(book, {}).get('hash') != hashes[book]]
+    for removed in set(store.books) - set(books):
+        del store.books[removed]
 
-def process_text(text):
-    encoded_tokens = encoding.encode(text)
-    return ' '.join(map(str, encoded_tokens))
+    # the text file can be appended to only if every book already in it is still current
+    base = store.index.get('base')
+    base_valid = (
+        base is not None and base['path'] == output_file and os.path.exists(output_file)
+        and os.path.getsize(output_file) >= base['bytes']
+        and all(book in store.books and book not in changed for book in base['books']))
+    if base_valid:
+        with open(output_file, 'r+b') as out_f:
+            out_f.truncate(base['bytes'])
+    else:
+        current = sorted(book for book in store.books if book not in changed)
+        write_base_from_store(store, output_file, current)
+        base = {'path': output_file, 'bytes': os.path.getsize(output_file), 'books': current}
+    missing = [book for book in books if book not in base['books'] or book in changed]
+    if missing:
+        # appended books are not deduplicated yet
+        base.pop('dedup', None)
+    store.index['base'] = base
+    store.save_index()
+    print(f"Streaming {len(missing)} of {len(books)} books, skipping {len(duplicates)} duplicate books")
 
-def digest_data(directory, output_file):
-    all_texts = []
-    for idx, filename in enumerate(os.listdir(directory)):
-        if filename.endswith('.txt'):
-            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as in_f:
-                all_texts.append(in_f.read())
-            print(f"Processed file {idx + 1} of {len(os.listdir(directory))}: {filename}")
-    processed_text = process_text(" ".join(all_texts))
-    with open(output_file, 'w') as out_f:
-        out_f.write(processed_text)
-
-def train_fasttext_model(base_path, model_path, min_count=1):
+    for name in os.listdir(store_dir):
+        if name.startswith('part_') and name.endswith('.tmp'):
+            os.remove(os.path.join(store_dir, name))
+
+    max_workers = max_workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * max_workers
+    writer = ShardWriter(store)
+    pending = iter(missing)
+    in_flight = {}
+    submitted = 0
+    done_count = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, open(output_file, 'a', encoding='utf-8') as out_f:
+        def commit(book, tokens):
+            nonlocal done_count
+            write_tokens_text(out_f, tokens)
+            out_f.flush()
+            base['books'].append(book)
+            base['bytes'] = out_f.tell()
+            store.save_index()
+            done_count += 1
+            print(f"Processed file {done_count} of {len(missing)}: {book}")
+
+        while True:
+            while len(in_flight) < max_in_flight:
+                book = next(pending, None)
+                if book is None:
+                    break
+                if book not in changed:
+                    # tokenized by an earlier, interrupted run
+                    commit(book, store.get(book))
+                    continue
+                part_path = os.path.join(store_dir, f'part_{submitted}.tmp')
+                submitted += 1
+                in_flight[executor.submit(encode_file_to_part, os.path.join(directory, book), part_path)] = book
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                book = in_flight.pop(future)
+                part_path = future.result()
+                writer.add_file(book, part_path, hashes[book])
+                writer.sync()
+                if os.path.getsize(part_path):
+                    commit(book, np.memmap(part_path, dtype=TOKEN_DTYPE, mode='r'))
+                else:
+                    commit(book, np.empty(0, dtype=TOKEN_DTYPE))
+                os.remove(part_path)
+    writer.close()
+    store.save_index()
+    compact_store(store)
+
+def dedup_digest(store_dir, output_file):
+    """
+    Remove the spans repeated across the token store (see dedup.py), write the report to
+    the store and rewrite the fastText text from the deduplicated tokens if they changed.
+    """
+    store = TokenStore(store_dir)
+    report = dedup_store(store)
+    report['duplicate_books'] = store.index.get('duplicates', {})
+    write_report(store, report)
+
+    base = store.index.get('base')
+    fingerprint = store.index['dedup']['fingerprint']
+    if base is None or base['path'] != output_file or base.get('dedup') != fingerprint:
+        books = sorted(store.books)
+        write_base_from_store(store, output_file, books)
+        store.index['base'] = {'path': output_file, 'bytes': os.path.getsize(output_file), 'books': books,
+                               'dedup': fingerprint}
+    store.save_index()
+    print(f"Dedup: removed {report['tokens_removed']} of {report['tokens_before']} tokens "
+          f"({report['removed_fraction']:.1%}) in {report['books_with_repeats']} books, "
+          f"skipped {len(report['duplicate_books'])} duplicate books")
+    return report
+
+def token_vectors(model):
+    """Token ids of the integer words of a fastText model and their vectors as one (words, dim) matrix."""
+    words = [word for word in model.words if word.isdigit()]
+    token_ids = np.array([int(word) for word in words], dtype=np.int64)
+    vectors = np.array([model.get_word_vector(word) for word in words], dtype=np.float32).reshape(-1, dim)
+    return token_ids, vectors
+
+def write_vectors(model_path, token_ids, vectors, table_path=None):
+    """Write the vec.vec text file in one bulk write, and the binary table if `table_path` is given."""
+    with open(model_path, 'w') as out_file:
+        out_file.write(f"{len(token_ids)} {vectors.shape[1]}\n")
+        np.savetxt(out_file, np.column_stack([token_ids, vectors]),
+                   fmt=['%d'] + ['%.8g'] * vectors.shape[1])
+    print(f"Vectors of {len(token_ids)} tokens saved to {model_path}.")
+    if table_path:
+        write_embedding_table(table_path, token_ids, vectors)
+
+def train_fasttext_model(base_path, model_path, min_count=1, table_path=None, pretrained_path=None):
+    """
+    Train CBOW token vectors on `base_path` and write them to `model_path` (and `table_path`).
+
+    With `pretrained_path`, training starts from the vectors of that .vec file and no
+    subword n-grams are used, so a pretrained token starts exactly at its old vector.
+    Returns the token ids and vectors.
+    """
+    options = {'pretrainedVectors': pretrained_path, 'maxn': 0} if pretrained_path else {}
     model = fasttext.train_unsupervised(
         input=base_path,
         model='cbow',
@@ -68,37 +233,117 @@ def train_fasttext_model(base_path, model_path, min_count=1):
         epoch=5,
         neg=1,
         bucket=200000,
-        minCount=min_count  # Adjust this as needed
+        minCount=min_count,  # Adjust this as needed
+        **options
     )
+    token_ids, vectors = token_vectors(model)
+    write_vectors(model_path, token_ids, vectors, table_path)
+    print("Training completed.")
+    return token_ids, vectors
 
-    words = model.words
+def stale_books(store):
+    """Books of the token store the embeddings were not trained on, or trained on an older version of."""
+    trained = store.index.get('embedding', {}).get('books', {})
+    return [book for book in sorted(store.books) if trained.get(book) != store.books[book]['hash']]
 
-    # Write the vectors to the vec.vec file
-    with open(model_path, 'w') as out_file:
-        out_file.write(f"{len(words)} {dim}\n")
-        decoded_words = []
-        for word in words:
-            vector = model[word]
-            try:
-                decoded_word = encoding.decode([int(word)])
-                decoded_words.append(decoded_word)
-            except:
-                pass
-            vector_str = ' '.join(map(str, vector))
-            out_file.write(f"{word} {vector_str}\n")
-        print(f'decoded words: {decoded_words}')
-    print(f"Vectors saved to {model_path}.")
+def record_embedded_books(store, books):
+    trained = store.index.setdefault('embedding', {}).setdefault('books', {})
+    trained.update({book: store.books[book]['hash'] for book in books})
+    store.save_index()
 
-    print("Training completed.")
+def vector_drift(old_ids, old_vectors, token_ids, vectors, present_ids):
+    """Mean of |new - old| / |old| over the tokens of `present_ids` that have an old and a new vector."""
+    ids = np.intersect1d(np.intersect1d(old_ids, token_ids), present_ids)
+    if not len(ids):
+        return 0.0
+    old_order, new_order = np.argsort(old_ids), np.argsort(token_ids)
+    old = old_vectors[old_order[np.searchsorted(old_ids[old_order], ids)]]
+    new = vectors[new_order[np.searchsorted(token_ids[new_order], ids)]]
+    moved = np.linalg.norm(new - old, axis=1) / np.maximum(np.linalg.norm(old, axis=1), 1e-12)
+    return float(moved.mean())
+
+def update_fasttext_model(store_dir, delta_path, model_path, table_path=None, update_existing=False):
+    """
+    Train the token vectors further on the books added to the token store since they were last
+    trained, warm-starting from `model_path`, instead of retraining on the whole corpus.
+
+    Tokens that already had a vector keep it unless `update_existing`, so models trained on
+    the old table stay valid; tokens first seen in the new books are added. Token ids are
+    the rows of the table in both cases, they never move.
+
+    fastText cannot freeze vectors, so the known tokens of the new books move while the new
+    tokens are fitted next to them, and the new vectors end up fitted to that moved context
+    when the old vectors are restored. The mean relative move of those known tokens is
+    printed and stored as the `drift` of the update in the store index; above
+    `DRIFT_WARNING` the new vectors are a poor fit for the old table and a full retrain
+    (--full) is suggested.
+    """
+    store = TokenStore(store_dir)
+    books = stale_books(store)
+    if not books:
+        print("Embeddings are up to date.")
+        return
+    print(f"Updating embeddings with {len(books)} new books")
+    write_base_from_store(store, delta_path, books)
+    old_ids, old_vectors = load_vec_file(model_path)
+    token_ids, vectors = train_fasttext_model(delta_path, model_path + '.tmp', pretrained_path=model_path)
+    os.remove(model_path + '.tmp')
+    present_ids = np.unique(np.concatenate([np.unique(store.get_kept(book)) for book in books]))
+    drift = vector_drift(old_ids, old_vectors, token_ids, vectors, present_ids)
+    print(f"Known tokens of the new books moved by {drift:.1%} on average during the update")
+    if not update_existing:
+        added = ~np.isin(token_ids, old_ids)
+        token_ids = np.concatenate([old_ids, token_ids[added]])
+        vectors = np.concatenate([old_vectors, vectors[added]])
+        print(f"Added vectors of {int(added.sum())} new tokens")
+        if drift > DRIFT_WARNING:
+            print(f"Warning: the new vectors were fitted next to known vectors that moved by {drift:.1%}, "
+                  f"more than {DRIFT_WARNING:.0%}; run with --full to retrain all vectors together")
+    write_vectors(model_path, token_ids, vectors, table_path)
+    store.index['embedding']['drift'] = drift
+    record_embedded_books(store, books)
+
+def build_vocab(table_path, store_dir, vocab_path):
+    """Build the vocabulary table of the corpus (see vocab.py) and print its coverage report."""
+    _, report = save_vocab_table(vocab_path, EmbeddingTable(table_path), TokenStore(store_dir))
+    print(f"Vocabulary: {report['vocab_tokens']} of {report['table_tokens']} table tokens, "
+          f"{report['corpus_tokens']} corpus tokens, coverage {report['coverage']:.4%}")
+    if report['oov_tokens']:
+        print(f"{report['oov_tokens']} tokens of {report['oov_distinct']} ids have no vector, "
+              f"most frequent: {report['top_oov'][:10]}, in books: {list(report['books_with_oov'])[:10]}")
+    return report
 
 if __name__ == "__main__":
+    import argparse
+    import logging
+
+    # the token store, embedding table and vocabulary modules report through logging
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Tokenize ./data and train the token vectors.')
+    parser.add_argument('--full', action='store_true', help='retrain the vectors on the whole corpus')
+    parser.add_argument('--update-existing', action='store_true',
+                        help='let an incremental update move the vectors of known tokens too')
+    args = parser.parse_args()
+
     DATA_DIR = './data'
     BASE_PATH = './models/base'
+    DELTA_PATH = './models/base_delta'
     MODEL_PATH = './models/vec.vec'
+    TOKENS_DIR = './tokenized_books'
+    TABLE_PATH = './models/vec.bin'
+    VOCAB_PATH = './models/vocab.npz'
     
     try:
-        parallel_digest_data(DATA_DIR, BASE_PATH, max_workers=10)
-        print("Starting training with FastText...")
-        train_fasttext_model(BASE_PATH, MODEL_PATH)
+        stream_digest_data(DATA_DIR, BASE_PATH, TOKENS_DIR, max_workers=10)
+        dedup_digest(TOKENS_DIR, BASE_PATH)
+        store = TokenStore(TOKENS_DIR)
+        if args.full or 'embedding' not in store.index or not os.path.exists(MODEL_PATH):
+            print("Starting training with FastText...")
+            train_fasttext_model(BASE_PATH, MODEL_PATH, table_path=TABLE_PATH)
+            record_embedded_books(store, sorted(store.books))
+        else:
+            update_fasttext_model(TOKENS_DIR, DELTA_PATH, MODEL_PATH, TABLE_PATH, update_existing=args.update_existing)
+        build_vocab(TABLE_PATH, TOKENS_DIR, VOCAB_PATH)
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -0,0 +1,145 @@
+import glob
+import io
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+CHECKPOINT_PATTERN = re.compile(r'ckpt-(\d+)\.npz$')
+
+
+def capture_rng_state():
+    """Python, NumPy and TensorFlow global RNG state as JSON-serializable values."""
+    version, python_state, gauss = random.getstate()
+    numpy_state = np.random.get_state()
+    return {
+        'python': [version, list(python_state), gauss],
+        'numpy': [numpy_state[0], numpy_state[1].tolist(), int(numpy_state[2]), int(numpy_state[3]), float(numpy_state[4])],
+        'tensorflow': tf.random.get_global_generator().state.numpy().tolist(),
+    }
+
+
+def restore_rng_state(state):
+    version, python_state, gauss = state['python']
+    random.setstate((version, tuple(python_state), gauss))
+    name, keys, pos, has_gauss, cached = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+    tf.random.get_global_generator().state.assign(np.array(state['tensorflow'], dtype=np.int64))
+
+
+def optimizer_weights(optimizer, model):
+    """Slots and iteration count of a legacy Keras optimizer, creating the slots if needed."""
+    optimizer._create_all_weights(model.trainable_variables)
+    return optimizer.get_weights()
+
+
+class AsyncCheckpointer:
+    """
+    Saves model weights, optimizer slots and training state off the training thread.
+
+    `save` only copies the variables to NumPy on the calling thread; a writer thread
+    serializes them to `ckpt-{step}.npz.tmp`, renames it to `ckpt-{step}.npz` so a crash
+    never leaves a partial checkpoint, and keeps the newest `keep` checkpoints.
+    """
+
+    def __init__(self, checkpoint_dir, keep=3):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.pending = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def save(self, model, step, state):
+        snapshot = {
+            'model': model.get_weights(),
+            'optimizer': optimizer_weights(model.optimizer, model),
+            'state': dict(state, step=step, rng=capture_rng_state()),
+        }
+        # blocks only if the writer is two checkpoints behind
+        self.pending.put((step, snapshot))
+
+    def _writer(self):
+        while True:
+            step, snapshot = self.pending.get()
+            try:
+                self._write(step, snapshot)
+            except Exception as e:
+                logging.error(f"Writing checkpoint {step} failed: {e}")
+            finally:
+                self.pending.task_done()
+
+    def _write(self, step, snapshot):
+        arrays = {'state': np.array(json.dumps(snapshot['state']))}
+        arrays.update({f'model_{i}': w for i, w in enumerate(snapshot['model'])})
+        arrays.update({f'optimizer_{i}': w for i, w in enumerate(snapshot['optimizer'])})
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+
+        path = os.path.join(self.checkpoint_dir, f'ckpt-{step:010d}.npz')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(buffer.getbuffer())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        logging.info(f"Saved checkpoint {path}")
+
+        for old in self.checkpoints()[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self.pending.join()
+
+    def checkpoints(self):
+        paths = glob.glob(os.path.join(self.checkpoint_dir, 'ckpt-*.npz'))
+        return sorted(path for path in paths if CHECKPOINT_PATTERN.search(path))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def restore(self, model, path):
+        """Load weights, optimizer slots and RNG state from `path`; returns the saved state."""
+        with np.load(path) as data:
+            state = json.loads(str(data['state']))
+            model.set_weights([data[f'model_{i}'] for i in range(len(model.get_weights()))])
+            optimizer_weights(model.optimizer, model)
+            model.optimizer.set_weights([data[f'optimizer_{i}'] for i in range(len(model.optimizer.get_weights()))])
+        restore_rng_state(state['rng'])
+        logging.info(f"Restored checkpoint {path} at step {state['step']}")
+        return state
+
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    """
+    Hands a checkpoint to `checkpointer` every `every_steps` batches and at every epoch end.
+
+    `state_fn(step)` returns the training state to store with the weights, e.g. the data
+    pipeline cursor after `step` trained batches.
+    """
+
+    def __init__(self, checkpointer, state_fn, every_steps, initial_step=0):
+        super(CheckpointCallback, self).__init__()
+        self.checkpointer = checkpointer
+        self.state_fn = state_fn
+        self.every_steps = every_steps
+        self.step = initial_step
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.every_steps and self.step % self.every_steps == 0:
+            self.checkpointer.save(self.model, self.step, self.state_fn(self.step))
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.every_steps or self.step % self.every_steps:
+            self.checkpointer.save(self.model, self.step, self.state_fn(self.step))
+
+    def on_train_end(self, logs=None):
+        self.checkpointer.wait()
@@ -0,0 +1,76 @@
+cfg = {
+    'sequenceSize': 512,
+    'dimension': 512,
+    'arrayDimension': 8,
+    'predictSteps': 8,
+    'batchSize': 2048,
+    'microBatchSize': 0,  # windows per gradient micro-batch, must divide the batch; 0 runs the whole batch at once
+    'recomputeLayers': False,  # recompute TransformerLayer activations in the backward pass instead of keeping them
+    'learningRate': 0.0005,
+    'decodeSamples': 16,  # validation windows decoded back to text at epoch end
+    'valWindows': 2048,  # fixed validation windows, sampled once from the validation books
+    'valBatchSize': 512,  # windows per model call when evaluating them
+    'valBackground': False,  # evaluate a copy of the weights in a thread, overlapped with training
+    'indexMode': 'exact',  # 'exact' or 'ivf' nearest-neighbour search in VectorIndex
+    'cacheInterleave': 4,  # generators interleaved in parallel over the dataset cache
+    'cacheMaxAgeDays': 7,  # dataset caches of other cfgs or tables unused for this long are deleted
+    'inputWorkers': 4,  # processes assembling train batches into shared memory, 0 uses the generators above
+    'windowStride': 8,  # tokens between window starts in a book
+    'shuffleSeed': 1337,
+    'fastLayer': True,  # TransformerLayer fast path, False runs the original implementation
+    'attentionMode': 'full',  # 'chunked' computes attention attentionChunk rows at a time, for long arrayDimension
+    'attentionChunk': 256,  # only saves memory when arrayDimension, the attended rows, is well above it
+    'jitCompile': False,  # compile the train step with XLA
+    'precisionPolicy': 'float32',  # or 'mixed_bfloat16' / 'mixed_float16', variables stay float32
+    'checkpointEvery': 500,  # train batches between background checkpoints
+    'checkpointKeep': 3,
+    'exportEvery': 10,  # epochs between SavedModel exports to model_path
+    'peakFlops': 312e12  # MFU reference, A100 bfloat16 peak; use the host's peak on CPU nodes
+}
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+
+def model_paths(cfg):
+    """Model id and the files a run of `cfg` reads and writes."""
+    model_id = f"{cfg['sequenceSize']}_{cfg['dimension']}"
+    return {
+        'model_id': model_id,
+        'model_path': f'./models/llm_{model_id}',
+        'checkpoint_path': f'checkpoint_{model_id}.txt',
+        'checkpoint_dir': f'./models/ckpt_{model_id}',
+    }
+
+
+def parse_override(cfg, override):
+    """
+    Parse a `key=value` override into (key, value), typed like the current value of `key`.
+
+    Args:
+    - cfg (dict): Config the key must already exist in.
+    - override (str): E.g. 'batchSize=512', 'fastLayer=false' or 'indexMode=ivf'.
+    """
+    key, sep, text = override.partition('=')
+    key = key.strip()
+    if not sep or key not in cfg:
+        raise ValueError(f"Invalid override {override!r}, expected key=value with key one of: {', '.join(cfg)}")
+    current = cfg[key]
+    text = text.strip()
+    if isinstance(current, bool):
+        if text.lower() not in TRUE_VALUES + FALSE_VALUES:
+            raise ValueError(f"Invalid boolean {text!r} for {key}")
+        return key, text.lower() in TRUE_VALUES
+    if isinstance(current, int):
+        return key, int(float(text)) if 'e' in text.lower() else int(text)
+    if isinstance(current, float):
+        return key, float(text)
+    return key, text
+
+
+def apply_overrides(cfg, overrides):
+    """Apply `key=value` overrides to `cfg` in place; returns `cfg`."""
+    for override in overrides or []:
+        key, value = parse_override(cfg, override)
+        cfg[key] = value
+    return cfg
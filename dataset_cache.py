@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from token_store import content_hash
+
+# cfg entries that change what is stored in the cache
+CACHE_CFG_KEYS = ('sequenceSize', 'predictSteps', 'arrayDimension')
+
+
+def dataset_cache_key(table_path, cfg):
+    """Key of the cache directory: the embedding table contents and the data-shaping cfg."""
+    h = hashlib.sha1()
+    h.update(content_hash(table_path).encode())
+    h.update(json.dumps({k: cfg[k] for k in CACHE_CFG_KEYS if k in cfg}, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+class DatasetCache:
+    """
+    On-disk cache of converted books, one float32 .npy file of shape (tokens, dim) per book.
+
+    Files are named after the book and the hash of its content, and live in a directory
+    named by `dataset_cache_key`, so a changed book, embedding table or cfg never reads a
+    stale entry. Opening a cache marks its directory as used; directories of other keys are
+    only removed once they have not been opened for `max_age_days`, so runs with another
+    cfg can share the cache root. Entries are opened with mmap, so training windows are
+    strided views over the page cache instead of an in-memory tf.data cache of the
+    expanded batches.
+    """
+
+    def __init__(self, cache_root, key, max_age_days=7):
+        self.cache_dir = os.path.join(cache_root, key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        os.utime(self.cache_dir)
+        oldest = time.time() - max_age_days * 86400
+        for name in os.listdir(cache_root):
+            path = os.path.join(cache_root, name)
+            if name != key and os.path.isdir(path) and os.path.getmtime(path) < oldest:
+                logging.info(f"Removing dataset cache {path}, unused for more than {max_age_days} days")
+                shutil.rmtree(path, ignore_errors=True)
+
+    def entry_path(self, book, book_hash):
+        name = hashlib.sha1(f'{book}:{book_hash}'.encode()).hexdigest()[:24]
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def get(self, book, book_hash, build_vectors, dtype=np.float32):
+        """
+        Return the cached vectors of `book`, calling `build_vectors()` and storing the
+        result as `dtype` first if the entry is missing.
+        """
+        path = self.entry_path(book, book_hash)
+        if not os.path.exists(path):
+            vectors = np.ascontiguousarray(build_vectors(), dtype=dtype)
+            # unique per process, workers of a local cluster may convert the same book
+            tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+            np.save(tmp_path, vectors)
+            os.replace(tmp_path, path)
+            logging.debug(f"Cached {book}: {vectors.shape} in {path}")
+        return np.load(path, mmap_mode='r')
+
+    def prune(self, entries):
+        """Delete files not belonging to any of the (book, book_hash) `entries`."""
+        keep = {os.path.basename(self.entry_path(book, book_hash)) for book, book_hash in entries}
+        for name in os.listdir(self.cache_dir):
+            if name not in keep and not name.endswith('.tmp.npy'):
+                os.remove(os.path.join(self.cache_dir, name))
@@ -0,0 +1,143 @@
+"""
+Deduplication of the tokenized corpus.
+
+Books whose text is byte-identical to an earlier book (in `list_books` order) are dropped
+before they are tokenized. Within the token store, every window of `span_tokens` tokens is
+hashed with a vectorized Adler-style rolling hash; a sample of the windows, those whose hash
+is 0 modulo `anchor_every`, serve as anchors, and an anchor whose hash already occurred
+earlier in the corpus marks its window as a repeat. The union of the repeated windows is
+removed from the book, so licence headers and footers, and books that are near copies of
+another, are kept once. Anchors are content-defined, so a repeated span is found wherever
+it starts; a repeat is removed from its first anchor to the end of its last anchor window.
+
+The result is stored in the token store index: every book with removed spans gets a
+`keep` list of [start, end) token ranges, read by `TokenStore.get_kept`.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Shortest repeated span that is removed, in tokens
+SPAN_TOKENS = 64
+# One window in this many (by hash) is an anchor; the anchor index takes 16 / ANCHOR_EVERY bytes per token
+ANCHOR_EVERY = 8
+REPORT_FILE = 'dedup_report.json'
+
+
+def mix64(values):
+    """splitmix64 finalizer, maps uint64 values to well spread uint64 hashes."""
+    x = np.asarray(values, dtype=np.uint64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def window_hashes(tokens, window):
+    """
+    64-bit hashes of all `len(tokens) - window + 1` windows of `window` consecutive tokens.
+
+    Adler-32 style: with x the mixed token values, a window [s, e) hashes its sum
+    a = sum(x_i) and its position weighted sum b = sum((e - i) * x_i), both taken from
+    prefix sums, so the whole book is hashed with a few vectorized passes. The sums wrap
+    modulo 2**64, which keeps the differences of prefix sums exact.
+    """
+    tokens = np.asarray(tokens)
+    n = len(tokens)
+    if n < window:
+        return np.empty(0, dtype=np.uint64)
+    x = mix64(tokens.astype(np.uint64) + np.uint64(0x9e3779b97f4a7c15))
+    positions = np.arange(n, dtype=np.uint64)
+    sums = np.zeros(n + 1, dtype=np.uint64)
+    np.cumsum(x, out=sums[1:])
+    weighted = np.zeros(n + 1, dtype=np.uint64)
+    np.cumsum(x * positions, out=weighted[1:])
+    ends = np.arange(window, n + 1, dtype=np.uint64)
+    a = sums[window:] - sums[:-window]
+    b = ends * a - (weighted[window:] - weighted[:-window])
+    return mix64(a ^ mix64(b))
+
+
+def duplicate_books(books, hashes):
+    """Map every book whose content hash equals that of an earlier book to the earliest one."""
+    first = {}
+    duplicates = {}
+    for book in books:
+        original = first.setdefault(hashes[book], book)
+        if original != book:
+            duplicates[book] = original
+    return duplicates
+
+
+def keep_ranges(length, repeat_starts, window):
+    """
+    [start, end) ranges of a book of `length` tokens left after removing the windows at
+    `repeat_starts`. Pieces shorter than `window` are dropped too, they are mostly the
+    edges of a repeat before its first anchor.
+    """
+    delta = np.zeros(length + 1, dtype=np.int32)
+    np.add.at(delta, repeat_starts, 1)
+    np.add.at(delta, np.minimum(repeat_starts + window, length), -1)
+    kept = np.concatenate([[False], np.cumsum(delta[:-1]) == 0, [False]])
+    ranges = np.flatnonzero(kept[1:] != kept[:-1]).reshape(-1, 2)
+    return ranges[ranges[:, 1] - ranges[:, 0] >= window].tolist()
+
+
+def dedup_store(store, books=None, span_tokens=SPAN_TOKENS, anchor_every=ANCHOR_EVERY):
+    """
+    Find the repeated spans of the books of a `TokenStore` and record what is kept of every
+    book in its index entry; the index is not saved.
+
+    Returns a dict with the tokens before and after and the books that lost the most tokens.
+    """
+    books = sorted(store.books) if books is None else list(books)
+    anchor_hashes = []
+    anchor_starts = []
+    for book in books:
+        hashes = window_hashes(store.get(book), span_tokens)
+        starts = np.flatnonzero(hashes % np.uint64(anchor_every) == 0)
+        anchor_hashes.append(hashes[starts])
+        anchor_starts.append(starts)
+
+    # anchors are in corpus order, so a stable sort puts the first occurrence of a hash first
+    all_hashes = np.concatenate(anchor_hashes) if books else np.empty(0, dtype=np.uint64)
+    order = np.argsort(all_hashes, kind='stable')
+    sorted_hashes = all_hashes[order]
+    repeat = np.zeros(len(all_hashes), dtype=bool)
+    repeat[order[1:]] = sorted_hashes[1:] == sorted_hashes[:-1]
+
+    tokens_before = tokens_after = 0
+    removed = {}
+    offset = 0
+    for book, starts in zip(books, anchor_starts):
+        entry = store.books[book]
+        book_repeats = starts[repeat[offset:offset + len(starts)]]
+        offset += len(starts)
+        entry.pop('keep', None)
+        tokens_before += entry['length']
+        if len(book_repeats):
+            entry['keep'] = keep_ranges(entry['length'], book_repeats, span_tokens)
+        kept = store.kept_length(book)
+        tokens_after += kept
+        if kept < entry['length']:
+            removed[book] = entry['length'] - kept
+
+    fingerprint = hashlib.sha1(json.dumps(
+        [span_tokens, anchor_every] + [[book, store.books[book]['hash'], store.books[book].get('keep')] for book in books]
+    ).encode()).hexdigest()
+    store.index['dedup'] = {'span_tokens': span_tokens, 'anchor_every': anchor_every, 'fingerprint': fingerprint}
+    return {
+        'books': len(books),
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_removed': tokens_before - tokens_after,
+        'removed_fraction': (tokens_before - tokens_after) / max(1, tokens_before),
+        'books_with_repeats': len(removed),
+        'most_removed': sorted(removed.items(), key=lambda item: -item[1])[:20],
+    }
+
+
+def write_report(store, report):
+    with open(os.path.join(store.store_dir, REPORT_FILE), 'w') as f:
+        json.dump(report, f, indent=1)
@@ -0,0 +1,108 @@
+"""
+Data-parallel training over several worker processes with MultiWorkerMirroredStrategy.
+
+Every worker reads its cluster and index from the TF_CONFIG environment variable, trains
+on its own share of the train books and keeps a full copy of the weights, gradients are
+all-reduced every step. `launch_local_workers` starts such a cluster on one machine:
+
+    python train.py train --workers 4
+
+On several nodes, start `python train.py train` on each with a TF_CONFIG that lists all
+of them; worker 0 is the chief and the only one writing checkpoints, the checkpoint txt
+and wandb logs. The workers must share the directory the chief checkpoints to.
+"""
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def worker_context():
+    """(worker index, number of workers) from TF_CONFIG; (0, 1) when not running in a cluster."""
+    tf_config = json.loads(os.environ.get('TF_CONFIG') or '{}')
+    workers = tf_config.get('cluster', {}).get('worker', [])
+    if len(workers) < 2:
+        return 0, 1
+    return int(tf_config['task']['index']), len(workers)
+
+
+def local_cluster_spec(num_workers, host='localhost'):
+    """Cluster of `num_workers` workers on free ports of this machine."""
+    ports = []
+    sockets = []
+    for _ in range(num_workers):
+        s = socket.socket()
+        s.bind((host, 0))
+        sockets.append(s)
+        ports.append(s.getsockname()[1])
+    for s in sockets:
+        s.close()
+    return {'worker': [f'{host}:{port}' for port in ports]}
+
+
+def launch_local_workers(num_workers, argv, script=None):
+    """
+    Run `script argv` in `num_workers` processes forming one local cluster and wait for them.
+
+    If a worker fails the others are terminated, as they would block on the next all-reduce.
+    Returns the first non-zero exit code, or 0.
+    """
+    script = script or sys.argv[0]
+    cluster = local_cluster_spec(num_workers)
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}))
+        processes.append(subprocess.Popen([sys.executable, script] + list(argv), env=env))
+    logging.info(f"Started {num_workers} local workers on {', '.join(cluster['worker'])}")
+
+    exit_code = 0
+    running = list(processes)
+    while running:
+        for process in list(running):
+            code = process.poll()
+            if code is None:
+                continue
+            running.remove(process)
+            if code and not exit_code:
+                exit_code = code
+                logging.error(f"Worker {processes.index(process)} exited with {code}, stopping the others")
+                for other in running:
+                    other.terminate()
+        time.sleep(0.5)
+    return exit_code
+
+
+def shard_books(books, lengths, num_shards):
+    """
+    Split `books` into `num_shards` lists of about the same number of tokens.
+
+    Books are assigned longest first to the shard with the fewest tokens, ties by name, so
+    every worker computes the same shards from the same (sorted) train books.
+    """
+    shards = [[] for _ in range(num_shards)]
+    totals = [0] * num_shards
+    for length, book in sorted(zip(lengths, books), key=lambda item: (-item[0], item[1])):
+        shard = totals.index(min(totals))
+        shards[shard].append(book)
+        totals[shard] += length
+    return [sorted(shard) for shard in shards]
+
+
+def export_model(model, model_path, is_chief=True):
+    """
+    SavedModel export that every worker must call: saving may run collective ops, so the
+    other workers write to a temporary directory that is removed again.
+    """
+    if is_chief:
+        model.save(model_path)
+        return
+    tmp_dir = tempfile.mkdtemp(prefix='llm_worker_')
+    try:
+        model.save(os.path.join(tmp_dir, os.path.basename(model_path)))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
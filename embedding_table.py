@@ -0,0 +1,128 @@
+import logging
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'FJLMEMB1'
+VERSION = 1
+# magic, version, dim, rows, matrix offset, bitmap offset
+HEADER_FORMAT = '<8sIIQQQ'
+HEADER_SIZE = 64
+
+
+def load_vec_file(vec_path):
+    """
+    Read a fastText text .vec file into token ids and a float32 matrix.
+
+    Words that are not integer token ids (fastText always adds '</s>') can not be
+    decoded by the tokenizer, so they are skipped.
+    """
+    token_ids = []
+    rows = []
+    with open(vec_path, 'r') as f:
+        header = f.readline().split()
+        dim = int(header[1])
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            word = parts[0]
+            if not word.isdigit():
+                continue
+            values = parts[1:]
+            token_ids.append(int(word))
+            rows.append([float(x) for x in values] if values else [0.0] * dim)
+    vectors = np.asarray(rows, dtype=np.float32).reshape(-1, dim)
+    return np.asarray(token_ids, dtype=np.int64), vectors
+
+
+def write_embedding_table(table_path, token_ids, vectors):
+    """
+    Write vectors as a contiguous float32 matrix indexed by token id plus a presence bitmap.
+
+    Args:
+    - table_path (str): Output path, usually './models/vec.bin'.
+    - token_ids (np.ndarray): Token id of every row in `vectors`.
+    - vectors (np.ndarray): Vectors of shape (len(token_ids), dim).
+    """
+    token_ids = np.asarray(token_ids, dtype=np.int64)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    dim = vectors.shape[1]
+    rows = int(token_ids.max()) + 1 if len(token_ids) else 0
+
+    matrix = np.zeros((rows, dim), dtype=np.float32)
+    matrix[token_ids] = vectors
+    present = np.zeros(rows, dtype=bool)
+    present[token_ids] = True
+
+    matrix_offset = HEADER_SIZE
+    bitmap_offset = matrix_offset + matrix.nbytes
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, dim, rows, matrix_offset, bitmap_offset)
+
+    # write to a temporary file first so readers never mmap a half-written table
+    tmp_path = table_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(matrix.tobytes())
+        f.write(np.packbits(present, bitorder='little').tobytes())
+    os.replace(tmp_path, table_path)
+    logging.info(f"Embedding table saved to {table_path}: {len(token_ids)} tokens, {rows} rows, dim {dim}.")
+
+
+class EmbeddingTable:
+    """
+    Read-only, memory-mapped view of a table written by `write_embedding_table`.
+
+    Opening the table only maps the file, so it costs the same for any vocabulary size
+    and every process that opens it shares the same pages of the page cache.
+    """
+
+    def __init__(self, table_path):
+        with open(table_path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        magic, version, dim, rows, matrix_offset, bitmap_offset = struct.unpack_from(HEADER_FORMAT, header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Error: {table_path} is not an embedding table (version {VERSION})")
+        self.path = table_path
+        self.dim = dim
+        self.rows = rows
+        self.vectors = np.memmap(table_path, dtype=np.float32, mode='r', offset=matrix_offset, shape=(rows, dim))
+        bitmap = np.memmap(table_path, dtype=np.uint8, mode='r', offset=bitmap_offset, shape=((rows + 7) // 8,))
+        self.present = np.unpackbits(bitmap, count=rows, bitorder='little').astype(bool)
+        self.empty_vec = np.zeros(dim, dtype=np.float32)
+
+    @property
+    def token_ids(self):
+        return np.flatnonzero(self.present)
+
+    def contains(self, token_ids):
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        in_range = (token_ids >= 0) & (token_ids < self.rows)
+        return in_range & self.present[np.where(in_range, token_ids, 0)]
+
+    def gather(self, token_ids):
+        """
+        Convert an array of token ids of any shape to vectors of shape (*shape, dim).
+
+        Tokens missing from the table map to `empty_vec`.
+        """
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        found = self.contains(token_ids)
+        if not found.all():
+            missing = np.unique(token_ids[~found])
+            logging.error(f"{len(missing)} tokens not found in embedding table, e.g. {missing[:10].tolist()}")
+        vectors = np.asarray(self.vectors)[np.where(found, token_ids, 0)]
+        vectors[~found] = self.empty_vec
+        return vectors
+
+
+def load_embedding_table(table_path, vec_path):
+    """Open `table_path`, converting `vec_path` to it first if the table is missing or older."""
+    stale = os.path.exists(vec_path) and (
+        not os.path.exists(table_path) or os.path.getmtime(table_path) < os.path.getmtime(vec_path))
+    if stale:
+        logging.info(f"Converting {vec_path} to binary embedding table {table_path}")
+        token_ids, vectors = load_vec_file(vec_path)
+        write_embedding_table(table_path, token_ids, vectors)
+    return EmbeddingTable(table_path)
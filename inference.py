@@ -0,0 +1,148 @@
+"""
+Autoregressive generation with a trained ./models/llm_{model_id} model.
+
+The model attends across the `arrayDimension` embedding channels of a window (that is the
+`pad_size` of TransformerLayer), and its first Conv1D mixes all `sequenceSize` token
+positions into every channel. Every key and value therefore depends on the whole window,
+so sliding the window by one token changes all of them and there is no per-token
+key/value projection to reuse. The engine instead keeps the step cheap in the ways this
+architecture allows: the model, embedding table and vector index are loaded once, the
+window is kept as embedded vectors and shifted in place, the forward pass is one traced
+fixed-shape function, and each forward pass emits `predictSteps` tokens, because output
+position t predicts input token t + predictSteps.
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+import tiktoken
+
+from embedding_table import load_embedding_table
+from quantization import QuantizedEmbeddingTable, load_int8_model
+from token_store import TokenStore
+from transformer import TransformerLayer
+from vector_index import VectorIndex
+from vocab import load_vocab_table
+
+
+class InferenceEngine:
+    """
+    Args:
+    - model_path (str): Saved Keras model, e.g. './models/llm_512_512'.
+    - table_path (str): Binary embedding table, converted from `vec_path` if needed.
+    - vec_path (str): fastText text vectors.
+    - index_mode (str): 'exact' or 'ivf' nearest-neighbour search.
+    - int8 (bool): `model_path` is an int8 export of `quantization.export_int8_model`, which
+      brings its own quantized embedding table; `table_path` and `vec_path` are not used.
+    - vocab_path (str): Vocabulary table of the training corpus (see vocab.py), used instead of
+      `table_path`; rebuilt like in training when it was built from another table or corpus.
+    - tokens_dir (str): Token store of the training corpus the vocabulary is checked against.
+    """
+
+    def __init__(self, model_path, table_path='./models/vec.bin', vec_path='./models/vec.vec', index_mode='exact',
+                 int8=False, vocab_path='./models/vocab.npz', tokens_dir='./tokenized_books'):
+        if int8:
+            self.model = load_int8_model(model_path)
+            self.embedding_table = QuantizedEmbeddingTable.load(os.path.join(model_path, 'table.npz'))
+            self.vector_index = VectorIndex(self.embedding_table.token_ids, self.embedding_table.codes,
+                                            mode=index_mode, scales=self.embedding_table.scales)
+        else:
+            self.model = tf.keras.models.load_model(model_path, custom_objects={'TransformerLayer': TransformerLayer}, compile=False)
+            self.embedding_table = load_vocab_table(vocab_path, load_embedding_table(table_path, vec_path),
+                                                    TokenStore(tokens_dir))
+            self.vector_index = VectorIndex.from_table(self.embedding_table, mode=index_mode)
+        self.tokenizer = tiktoken.encoding_for_model("gpt-4")
+        # train.py builds the model as Input(shape=(sequenceSize, predictSteps))
+        _, self.sequence_size, self.predict_steps = self.model.input_shape
+        self.dim = self.embedding_table.dim
+        self._forward = tf.function(
+            lambda windows: self.model(windows, training=False),
+            input_signature=[tf.TensorSpec([None, self.sequence_size, self.dim], tf.float32)])
+        logging.info(f"Loaded {model_path}: sequenceSize {self.sequence_size}, predictSteps {self.predict_steps}")
+
+    def forward(self, windows):
+        """Predicted vectors of shape (batch, sequenceSize, dim) for embedded windows."""
+        return self._forward(tf.convert_to_tensor(windows, dtype=tf.float32)).numpy()
+
+    def embed_windows(self, prompts):
+        """Right-aligned embedded windows for token id lists; short prompts are padded with empty_vec."""
+        windows = np.zeros((len(prompts), self.sequence_size, self.dim), dtype=np.float32)
+        for row, tokens in enumerate(prompts):
+            tokens = np.asarray(tokens, dtype=np.int64)[-self.sequence_size:]
+            if len(tokens):
+                windows[row, -len(tokens):] = self.embedding_table.gather(tokens)
+        return windows
+
+    def pick_tokens(self, predictions, top_k=1, temperature=1.0, rng=None):
+        """
+        Choose a token for every predicted vector: the nearest one, or one of the `top_k`
+        nearest sampled with probability proportional to exp(-distance / temperature).
+        """
+        if top_k <= 1:
+            return self.vector_index.decode(predictions)
+        candidates, distances = self.vector_index.search(predictions, k=top_k)
+        logits = -(distances - distances.min(axis=-1, keepdims=True)) / max(temperature, 1e-6)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=-1, keepdims=True)
+        rng = rng or np.random.default_rng()
+        cumulative = probs.cumsum(axis=-1)
+        choice = (rng.random(cumulative.shape[:-1] + (1,)) > cumulative).sum(axis=-1)
+        choice = np.minimum(choice, candidates.shape[-1] - 1)
+        return np.take_along_axis(candidates, choice[..., None], axis=-1)[..., 0]
+
+    def generate(self, prompts, num_tokens, top_k=1, temperature=1.0, seed=None):
+        """
+        Generate `num_tokens` tokens after every prompt (a list of token id lists) in one batch.
+
+        Returns the generated token ids, shape (len(prompts), num_tokens), and stats with
+        forward passes and tokens/sec.
+        """
+        rng = np.random.default_rng(seed)
+        windows = self.embed_windows(prompts)
+        generated = np.empty((len(prompts), 0), dtype=np.int64)
+        forward_passes = 0
+        start = time.perf_counter()
+        while generated.shape[1] < num_tokens:
+            predictions = self.forward(windows)
+            forward_passes += 1
+            step = min(self.predict_steps, num_tokens - generated.shape[1])
+            new_tokens = self.pick_tokens(predictions[:, -self.predict_steps:][:, :step], top_k, temperature, rng)
+            generated = np.concatenate([generated, new_tokens], axis=1)
+            # shift the window in place and append the embeddings of the chosen tokens
+            windows[:, :-step] = windows[:, step:]
+            windows[:, -step:] = self.embedding_table.gather(new_tokens)
+        elapsed = time.perf_counter() - start
+        stats = {
+            'forward_passes': forward_passes,
+            'seconds': elapsed,
+            'tokens_per_sec': generated.size / elapsed if elapsed else 0.0,
+        }
+        return generated, stats
+
+    def generate_text(self, prompt, num_tokens, **kwargs):
+        generated, stats = self.generate([self.tokenizer.encode(prompt)], num_tokens, **kwargs)
+        return self.tokenizer.decode(generated[0].tolist()), stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Generate text with a trained model.')
+    parser.add_argument('--model-id', default='512_512', help="model directory suffix, ./models/llm_{model_id}")
+    parser.add_argument('--prompt', default='')
+    parser.add_argument('--tokens', type=int, default=64)
+    parser.add_argument('--top-k', type=int, default=1)
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--batch', type=int, default=1, help='copies of the prompt generated together')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--int8', action='store_true', help='use the int8 export ./models/llm_{model_id}_int8')
+    args = parser.parse_args()
+
+    engine = InferenceEngine(f"./models/llm_{args.model_id}{'_int8' if args.int8 else ''}", int8=args.int8)
+    prompt_tokens = engine.tokenizer.encode(args.prompt)
+    generated, stats = engine.generate([prompt_tokens] * args.batch, args.tokens, top_k=args.top_k,
+                                       temperature=args.temperature, seed=args.seed)
+    print(engine.tokenizer.decode(generated[0].tolist()))
+    print(f"{stats['forward_passes']} forward passes, {stats['tokens_per_sec']:.1f} tokens/sec")
@@ -0,0 +1,169 @@
+import atexit
+import multiprocessing
+import os
+import sys
+import time
+import types
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from sampler import assemble_batch
+
+# filesystem backing SharedMemory on Linux, 64 MB by default in docker containers
+SHM_DIR = '/dev/shm'
+
+
+def ring_bytes(slot_shape, num_slots):
+    """Shared memory taken by `num_slots` float32 (x, y) batches of `slot_shape`."""
+    return num_slots * 2 * int(np.prod(slot_shape)) * 4
+
+
+def shm_free_bytes(shm_dir=SHM_DIR):
+    """Free bytes of the shared memory filesystem, None where shared memory is not backed by `shm_dir`."""
+    if not os.path.isdir(shm_dir):
+        return None
+    stat = os.statvfs(shm_dir)
+    return stat.f_bavail * stat.f_frsize
+
+
+def fit_ring(slot_shape, num_workers, slots_per_worker, free_bytes):
+    """
+    Workers and slots per worker of the largest ring of at most `num_workers` x
+    `slots_per_worker` slots that takes no more than half of `free_bytes`, giving up slots
+    per worker before workers. (0, 0) when a single slot does not fit.
+    """
+    slot_bytes = ring_bytes(slot_shape, 1)
+    budget = free_bytes // 2
+    slots = min(slots_per_worker, budget // (slot_bytes * num_workers))
+    if slots >= 1:
+        return num_workers, slots
+    workers = budget // slot_bytes
+    return (workers, 1) if workers >= 1 else (0, 0)
+
+
+@contextmanager
+def _bare_main():
+    """
+    Hide the `__main__` module while workers are spawned. A spawned child runs the parent's
+    main script again, as `__mp_main__`, before it unpickles its target; for train.py that
+    imports TensorFlow in every worker, hundreds of MB and seconds of startup each, while
+    the workers only need this module and NumPy.
+    """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def _worker_loop(worker, num_workers, vector_paths, sampler, start_epoch, start_step, shm_name, slot_shape,
+                 num_slots, free, filled, assembly_seconds):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray((num_slots, 2) + slot_shape, dtype=np.float32, buffer=shm.buf)
+    book_vectors = [np.load(path, mmap_mode='r') for path in vector_paths]
+    if sampler.steps_per_epoch == 0:
+        return
+    # batches are numbered from the start of the run, batch n is assembled by worker
+    # n % num_workers into slot n % num_slots, which therefore always belongs to this worker
+    position = 0
+    epoch = start_epoch
+    while True:
+        first = start_step if epoch == start_epoch else 0
+        # step s of this epoch is batch position + s - first of the run
+        shard = (worker - position + first) % num_workers
+        for step, books, starts in sampler.iter_epoch(epoch, first, shard, num_workers):
+            slot = (position + step - first) % num_slots
+            free[slot].acquire()
+            start = time.perf_counter()
+            assemble_batch(book_vectors, books, starts, sampler.sequence_size, sampler.predict_steps,
+                           out=(slots[slot, 0], slots[slot, 1]))
+            assembly_seconds[worker] += time.perf_counter() - start
+            filled[slot].release()
+        position += sampler.steps_per_epoch - first
+        epoch += 1
+
+
+class ParallelBatchLoader:
+    """
+    Assembles the batches of a `WindowSampler` in worker processes, straight into a ring of
+    shared-memory slots, and hands them out in step order.
+
+    Worker k assembles batches k, k + n, ... of the run, so the batches and their order are
+    the same as `sampler.iter_epoch` gives in one process, whatever the number of workers.
+    Each worker owns `slots_per_worker` slots and can be that many batches ahead of the
+    consumer. A batch returned by iteration stays valid until the next one is requested.
+    The ring takes `ring_bytes(slot_shape, num_workers * slots_per_worker)` of /dev/shm,
+    see `fit_ring` to size it to the free space.
+
+    Args:
+    - vector_paths (list[str]): .npy file of the (tokens, dim) vectors of every sampler book,
+      e.g. dataset cache entries; workers open them with mmap.
+    - sampler (WindowSampler): Batch plan, pickled to the workers.
+    - num_workers (int): Worker processes.
+    - start_epoch (int): Epoch of the first batch.
+    - start_step (int): Step of the first batch in `start_epoch`.
+    - slots_per_worker (int): Ready batches buffered per worker.
+    """
+
+    def __init__(self, vector_paths, sampler, num_workers, start_epoch=0, start_step=0, slots_per_worker=2):
+        dim = np.load(vector_paths[0], mmap_mode='r').shape[-1] if len(vector_paths) else 0
+        self.slot_shape = (sampler.batch_size, sampler.sequence_size, dim)
+        self.num_workers = num_workers
+        self.num_slots = num_workers * slots_per_worker
+        nbytes = max(1, ring_bytes(self.slot_shape, self.num_slots))
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.slots = np.ndarray((self.num_slots, 2) + self.slot_shape, dtype=np.float32, buffer=self.shm.buf)
+
+        # spawn instead of fork, the parent runs TensorFlow threads
+        context = multiprocessing.get_context('spawn')
+        self.free = [context.Semaphore(1) for _ in range(self.num_slots)]
+        self.filled = [context.Semaphore(0) for _ in range(self.num_slots)]
+        self.assembly_seconds = context.Array('d', num_workers, lock=False)
+        self.processes = [
+            context.Process(target=_worker_loop, daemon=True, args=(
+                worker, num_workers, list(vector_paths), sampler, start_epoch, start_step, self.shm.name,
+                self.slot_shape, self.num_slots, self.free, self.filled, self.assembly_seconds))
+            for worker in range(num_workers)
+        ]
+        with _bare_main():
+            for process in self.processes:
+                process.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def total_assembly_seconds(self):
+        """Seconds all workers have spent assembling batches so far."""
+        return float(sum(self.assembly_seconds))
+
+    def _wait(self, slot):
+        while not self.filled[slot].acquire(timeout=1.0):
+            for worker, process in enumerate(self.processes):
+                if not process.is_alive():
+                    raise RuntimeError(f"Input worker {worker} exited with code {process.exitcode}")
+
+    def __iter__(self):
+        position = 0
+        while True:
+            slot = position % self.num_slots
+            self._wait(slot)
+            yield self.slots[slot, 0], self.slots[slot, 1]
+            self.free[slot].release()
+            position += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        del self.slots
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # a batch is still referenced, the mapping goes away with it
+        self.shm.unlink()
@@ -0,0 +1,225 @@
+import csv
+import json
+import logging
+import os
+import time
+
+import tensorflow as tf
+
+from profiler import STAGES, estimate_mfu
+from transformer import TransformerLayer
+
+
+def make_optimizer(learning_rate, last_epoch, max_iters=10000, decay_rate=0.96):
+    """Legacy Adam with a staircase exponential decay over the epochs left after `last_epoch`."""
+    lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
+        learning_rate,
+        decay_steps=max_iters - last_epoch,
+        decay_rate=decay_rate,
+        staircase=True)  # If True, decay the learning rate at discrete intervals
+
+    # WARNING:absl:At this time, the v2.11+ optimizer `tf.keras.optimizers.Adam` runs slowly on M1/M2 Macs, please use the legacy Keras optimizer instead, located at `tf.keras.optimizers.legacy.Adam`.
+    return tf.keras.optimizers.legacy.Adam(learning_rate=lr_schedule)
+
+
+class MicroBatchModel(tf.keras.Model):
+    """
+    Functional model whose train step splits every batch into micro-batches of
+    `micro_batch_size` windows, run one after another, and applies the mean of their
+    gradients once. The update is that of the whole batch, and the optimizer, its learning
+    rate schedule and the metrics still count one step per batch, but only the activations
+    of one micro-batch are alive at a time. 0 trains on the whole batch at once.
+    """
+
+    micro_batch_size = 0
+
+    def train_step(self, data):
+        if not self.micro_batch_size:
+            return super(MicroBatchModel, self).train_step(data)
+        x, y, _ = tf.keras.utils.unpack_x_y_sample_weight(data)
+        size = self.micro_batch_size
+        batch_size = tf.shape(x)[0]
+        tf.debugging.assert_equal(batch_size % size, 0, message=f"microBatchSize {size} does not divide the batch")
+        num_micro = batch_size // size
+        variables = self.trainable_variables
+        scaled = isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+
+        def accumulate(i, gradients):
+            x_micro, y_micro = x[i * size:(i + 1) * size], y[i * size:(i + 1) * size]
+            with tf.GradientTape() as tape:
+                y_pred = self(x_micro, training=True)
+                loss = self.compute_loss(x_micro, y_micro, y_pred)
+                if scaled:
+                    loss = self.optimizer.get_scaled_loss(loss)
+            micro_gradients = tape.gradient(loss, variables)
+            if scaled:
+                micro_gradients = self.optimizer.get_unscaled_gradients(micro_gradients)
+            self.compiled_metrics.update_state(y_micro, y_pred)
+            return i + 1, [total + gradient for total, gradient in zip(gradients, micro_gradients)]
+
+        # one micro-batch at a time, so their activations are never alive together
+        _, gradients = tf.while_loop(
+            lambda i, _: i < num_micro, accumulate, [tf.constant(0), [tf.zeros_like(v) for v in variables]],
+            parallel_iterations=1)
+        mean = 1.0 / tf.cast(num_micro, tf.float32)
+        self.optimizer.apply_gradients(zip([gradient * mean for gradient in gradients], variables))
+
+        results = {}
+        for metric in self.metrics:
+            result = metric.result()
+            if isinstance(result, dict):
+                results.update(result)
+            else:
+                results[metric.name] = result
+        return results
+
+
+def build_model(cfg):
+    """The uncompiled Keras model of `cfg`: windows of (sequenceSize, predictSteps) in, predicted vectors out."""
+    input = tf.keras.layers.Input(shape=(cfg['sequenceSize'], cfg['predictSteps']))
+
+    x = tf.keras.layers.Permute((2, 1))(input)
+    logging.debug(f"Shape of x after permute: {x.shape}")
+
+    x = tf.keras.layers.Conv1D(filters=cfg['dimension'], kernel_size=1, strides=1, padding="same", activation="mish")(x)
+    logging.debug(f"Shape of x after Conv1D: {x.shape}")
+    x = TransformerLayer(depth=cfg['dimension'], num_heads=4, pad_size=cfg['arrayDimension'], fast=cfg['fastLayer'],
+                         recompute=cfg['recomputeLayers'], attention=cfg['attentionMode'], chunk_size=cfg['attentionChunk'])(x)
+    logging.debug(f"Shape of x after first TransformerLayer: {x.shape}")
+    x = TransformerLayer(depth=cfg['sequenceSize'], num_heads=4, pad_size=cfg['arrayDimension'], fast=cfg['fastLayer'],
+                         recompute=cfg['recomputeLayers'], attention=cfg['attentionMode'], chunk_size=cfg['attentionChunk'])(x)
+    logging.debug(f"Shape of x after second TransformerLayer: {x.shape}")
+
+    x3a = tf.keras.layers.Permute((2, 1))(x)
+    # keep the predicted vectors and the loss in float32 under mixed precision
+    x1 = tf.keras.layers.Dense(units=cfg['arrayDimension'], activation="linear", dtype='float32')(x3a)
+    return tf.keras.Model(inputs=[input], outputs=[x1])
+
+
+def load_or_build_model(cfg, model_path, optimizer):
+    """
+    Load the saved model at `model_path` if there is one, keeping its optimizer, otherwise
+    build a new one; either way it is compiled as a `MicroBatchModel` with the micro-batch
+    size, and the TransformerLayers run the fast path, activation recomputation and
+    attention of `cfg`, whatever the saved model was built with.
+    """
+    ignored = [name for name, requested in [('recomputeLayers', cfg['recomputeLayers']),
+                                             (f"attentionMode={cfg['attentionMode']}", cfg['attentionMode'] != 'full')]
+               if requested]
+    if ignored and not cfg['fastLayer']:
+        logging.warning(f"{' and '.join(ignored)} only apply to the fast TransformerLayer path, ignored with fastLayer=false")
+    if os.path.exists(model_path):
+        saved = tf.keras.models.load_model(
+            model_path, custom_objects={'TransformerLayer': TransformerLayer, 'MicroBatchModel': MicroBatchModel})
+        optimizer = saved.optimizer or optimizer
+        for layer in saved.layers:
+            if isinstance(layer, TransformerLayer):
+                # both paths use the same variables, so a saved model can switch between them
+                layer.fast = cfg['fastLayer']
+                layer.recompute = cfg['recomputeLayers']
+                layer.attention, layer.chunk_size = cfg['attentionMode'], cfg['attentionChunk']
+        logging.info("Loaded model from disk.")
+    else:
+        saved = build_model(cfg)
+    # a new model object over the same layers and variables
+    model = MicroBatchModel(inputs=saved.inputs, outputs=saved.outputs, name=saved.name)
+    model.micro_batch_size = cfg['microBatchSize']
+    model.compile(loss=tf.keras.losses.Huber(), metrics=['accuracy'], optimizer=optimizer, jit_compile=cfg['jitCompile'])
+    return model
+
+
+def model_flops_per_window(model):
+    """
+    Forward FLOPs of one input window, counted from the layers of the built model:
+    2 * multiply-adds of every matmul, including the attention products of TransformerLayer.
+    """
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, TransformerLayer):
+            pad, depth = layer.pad_size, layer.depth
+            input_size = layer.input_dense_weight.shape[0]
+            flops += 2 * pad * input_size * depth  # input projection
+            flops += 2 * pad * depth * depth * 6  # query, key, value, output, two feed-forward
+            flops += 2 * 2 * pad * pad * depth  # logits and attention * value over all heads
+        elif isinstance(layer, (tf.keras.layers.Dense, tf.keras.layers.Conv1D)):
+            positions = 1
+            for size in layer.output_shape[1:-1]:
+                positions *= size
+            flops += 2 * int(tf.size(layer.kernel)) * positions
+    return flops
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """
+    Times every train step, and at epoch end turns the profiler totals into tokens/sec and
+    MFU. Each summary is appended to `{log_prefix}.jsonl` and `{log_prefix}.csv`, and kept
+    in `self.summary` so other callbacks can send it to wandb. The stages timed before fit
+    (loading the books and their vectors) are written once as a `startup` line of the JSON
+    file, and kept in `self.startup`, before the profiler is reset for the first epoch.
+
+    Args:
+    - profiler (PipelineProfiler): Shared with the input pipeline.
+    - windows_per_step (int): batchSize.
+    - tokens_per_window (int): sequenceSize, the predicted positions of a window.
+    - peak_flops (float): Peak FLOPS of the device the MFU is relative to.
+    - log_prefix (str): Path prefix of the JSON and CSV files.
+    - initial_step (int): Steps trained before this run, counted in `total_tokens`.
+    """
+
+    def __init__(self, profiler, windows_per_step, tokens_per_window, peak_flops, log_prefix, initial_step=0):
+        super(ThroughputCallback, self).__init__()
+        self.profiler = profiler
+        self.windows_per_step = windows_per_step
+        self.tokens_per_window = tokens_per_window
+        self.peak_flops = peak_flops
+        self.log_prefix = log_prefix
+        self.total_steps = initial_step
+        self.summary = {}
+        self.startup = {}
+        os.makedirs(os.path.dirname(log_prefix) or '.', exist_ok=True)
+
+    def on_train_begin(self, logs=None):
+        self.startup = self.profiler.snapshot()
+        if self.startup:
+            logging.info(f"Startup stages: {self.startup}")
+            with open(self.log_prefix + '.jsonl', 'a') as f:
+                f.write(json.dumps({'startup': True, 'stages': self.startup}) + '\n')
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.profiler.reset()
+        self.epoch_start = time.perf_counter()
+        self.steps = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.profiler.add('train_step', time.perf_counter() - self.step_start)
+        self.steps += 1
+        self.total_steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        dt = time.perf_counter() - self.epoch_start
+        stages = self.profiler.snapshot()
+        flops_per_step = model_flops_per_window(self.model) * self.windows_per_step
+        tokens = self.steps * self.windows_per_step * self.tokens_per_window
+        self.summary = {
+            'epoch': epoch,
+            'seconds': dt,
+            'steps': self.steps,
+            'total_tokens': self.total_steps * self.windows_per_step * self.tokens_per_window,
+            'tokens_per_sec': tokens / dt if dt > 0 else 0.0,
+            'mfu': estimate_mfu(flops_per_step, self.steps, dt, self.peak_flops),
+            **{f'{stage}_seconds': stages.get(stage, {}).get('seconds', 0.0) for stage in STAGES},
+        }
+        logging.info(f"Throughput: {self.summary['tokens_per_sec']:.0f} tokens/sec, MFU {self.summary['mfu'] * 100:.2f}%, stages: {stages}")
+
+        with open(self.log_prefix + '.jsonl', 'a') as f:
+            f.write(json.dumps({**self.summary, 'stages': stages}) + '\n')
+        csv_path = self.log_prefix + '.csv'
+        write_header = not os.path.exists(csv_path)
+        with open(csv_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(sorted(self.summary))
+            writer.writerow([self.summary[key] for key in sorted(self.summary)])
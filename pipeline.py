@@ -0,0 +1,151 @@
+"""
+Data pipeline of train.py: the book list and its train/val split, the token shards, the
+embedding table with its vector index, and the on-disk cache of converted books.
+
+Every resource is opened on first use and then shared, so importing this module reads
+nothing from disk and `cfg` overrides applied before the first call are respected.
+"""
+import hashlib
+import json
+import logging
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from config import cfg
+from dataset_cache import DatasetCache, dataset_cache_key
+from embedding_table import load_embedding_table
+from profiler import PipelineProfiler
+from token_store import TokenStore, content_hash, list_books as list_book_files
+from vector_index import VectorIndex
+from vocab import load_vocab_table
+
+DATA_DIR = './data'
+TABLE_PATH = './models/vec.bin'
+VEC_PATH = './models/vec.vec'
+VOCAB_PATH = './models/vocab.npz'
+TOKENS_DIR = './tokenized_books'
+CACHE_DIR = './dataset_cache'
+
+# Stage timings of the input pipeline and the train step
+profiler = PipelineProfiler()
+
+
+@lru_cache(maxsize=None)
+def get_embedding_table():
+    """
+    Vocabulary table of the tokens in the token store, built from the binary embedding table
+    on first use, which is converted from ./models/vec.vec first if needed.
+    """
+    embedding_table = load_embedding_table(TABLE_PATH, VEC_PATH)
+    assert embedding_table.contains(11)
+    return load_vocab_table(VOCAB_PATH, embedding_table, get_token_store())
+
+
+@lru_cache(maxsize=None)
+def get_vector_index():
+    return VectorIndex.from_table(get_embedding_table(), mode=cfg['indexMode'])
+
+
+@lru_cache(maxsize=None)
+def get_token_store():
+    """Token shards written by build_tokens.py, read through mmap."""
+    return TokenStore(TOKENS_DIR)
+
+
+@lru_cache(maxsize=None)
+def get_dataset_cache():
+    """Converted books on disk, invalidated when vec.bin or the data cfg changes."""
+    get_embedding_table()  # the cache key hashes vec.bin, so convert vec.vec first
+    return DatasetCache(CACHE_DIR, dataset_cache_key(TABLE_PATH, cfg), cfg['cacheMaxAgeDays'])
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    import tiktoken
+    return tiktoken.encoding_for_model("gpt-4")
+
+
+def list_books():
+    """Books of DATA_DIR, without those build_tokens.py found to be copies of another book."""
+    duplicates = get_token_store().index.get('duplicates', {})
+    # the same listing build_tokens.py tokenizes, so books in subdirectories are found too
+    return [book for book in list_book_files(DATA_DIR) if book not in duplicates]
+
+
+# Split into train and test based on hashes derived from the filenames
+# in this way, we can add/remove new files and train/test files will not be mixed
+def hash_based_split(filenames, test_split=0.2):
+    train_files = []
+    test_files = []
+    for filename in filenames:
+        hash_val = hashlib.md5(filename.encode()).hexdigest()
+        hash_num = int(hash_val, 16) / float(1 << 128)
+        if hash_num < test_split:
+            test_files.append(filename)
+        else:
+            train_files.append(filename)
+    return train_files, test_files
+
+
+def train_val_split(books=None):
+    train_books, val_books = hash_based_split(list_books() if books is None else books, test_split=0.2)
+    logging.info(f"Found train books: {len(train_books)}, test books: {len(val_books)}")
+    return train_books, val_books
+
+
+def reparse(v):
+    return get_tokenizer().decode(reverser(v).tolist())
+
+
+def reverser(arr):
+    """Map a vector, or any (..., dim) array of vectors, to the nearest token ids."""
+    return get_vector_index().decode(arr)
+
+
+def convert(tokens):
+    """Gather the vectors of a token id or an array of token ids in one lookup."""
+    return get_embedding_table().gather(tokens)
+
+
+def book_hash(book_path):
+    """Version of a book for the dataset cache: its content hash, plus the ranges deduplication kept."""
+    entry = get_token_store().books.get(book_path)
+    if entry is None:
+        return content_hash(os.path.join(DATA_DIR, book_path))
+    if 'keep' not in entry:
+        return entry['hash']
+    return hashlib.sha1(json.dumps([entry['hash'], entry['keep']]).encode()).hexdigest()
+
+
+def book_length(book_path):
+    """Tokens of a book after deduplication, from the token store index if possible."""
+    token_store = get_token_store()
+    return token_store.kept_length(book_path) if book_path in token_store else len(load_book_vectors(book_path))
+
+
+def tokenize_book(book_path):
+    token_store = get_token_store()
+    with profiler.stage('shard_read'):
+        book = token_store.get_kept(book_path)
+        if book is not None:
+            return np.asarray(book, dtype=np.int64)
+    logging.warning(f'Tokenized book {book_path} is not in {token_store.store_dir}, will perform tokenization')
+    with profiler.stage('tokenize_fallback'):
+        full_path = os.path.join(DATA_DIR, book_path)
+        with open(full_path, 'r') as f:
+            book = f.read()
+        return np.asarray(get_tokenizer().encode(book), dtype=np.int64)
+
+
+def build_book_vectors(book_path):
+    tokens = tokenize_book(book_path)
+    with profiler.stage('embedding_conversion'):
+        return convert(tokens)
+
+
+def load_book_vectors(book_path):
+    """Vectors of a whole book from the on-disk dataset cache, converting it on first use."""
+    with profiler.stage('cache_read'):
+        return get_dataset_cache().get(book_path, book_hash(book_path), lambda: build_book_vectors(book_path))
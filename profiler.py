@@ -0,0 +1,50 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# stages reported in every summary, in CSV column order
+STAGES = ('shard_read', 'tokenize_fallback', 'embedding_conversion', 'cache_read', 'batch_assembly', 'queue_wait', 'train_step')
+
+
+class PipelineProfiler:
+    """
+    Thread-safe accumulator of wall time per named stage.
+
+    Input pipeline stages are timed where they run (generator threads included), the
+    train step by `model.ThroughputCallback`. `queue_wait` is the time a generator spends
+    suspended after yielding a batch, i.e. waiting for the consumer: when it is close to
+    zero the trainer is starved and the run is input-bound.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = {}
+            self.counts = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {stage: {'seconds': self.seconds[stage], 'count': self.counts[stage]} for stage in self.seconds}
+
+
+def estimate_mfu(flops_per_step, steps, dt, peak_flops):
+    """Model FLOPs utilization of `steps` training steps (forward + backward = 3x forward) in `dt` seconds."""
+    if dt <= 0:
+        return 0.0
+    return 3 * flops_per_step * steps / dt / peak_flops
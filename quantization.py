@@ -0,0 +1,223 @@
+"""
+Int8 export of a trained model and its embedding table, for inference.
+
+The dense kernels of every TransformerLayer are stored as int8 with one float32 scale per
+output channel, the embedding table as int8 with one scale per token row. Biases, the
+gates, the Conv1D and the output Dense stay float32, they are a small fraction of the
+weights. At inference `QuantizedTransformerLayer` keeps the kernels as int8 variables and
+dequantizes them inside the forward pass, so a loaded model holds a quarter of the kernel
+memory, and `VectorIndex` searches the int8 table rows directly.
+
+    export_dir/model.json    Keras model config
+    export_dir/weights.npz   int8 codes and scales, float32 for the rest
+    export_dir/table.npz     token ids, int8 codes and row scales of the embedding table
+    export_dir/report.json   accuracy against the float model, written by train.py quantize
+"""
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from transformer import TransformerLayer
+from validation import huber_loss
+
+# TransformerLayer kernels stored as int8, in build order
+QUANTIZED_KERNELS = ('input_dense_weight', 'query_dense_weight', 'key_dense_weight', 'value_dense_weight',
+                     'dense_weight', 'ff_dense1_weight', 'ff_dense2_weight')
+FLOAT_WEIGHTS = ('random_id_att', 'random_id_ff', 'input_dense_bias', 'query_dense_bias', 'key_dense_bias',
+                 'value_dense_bias', 'dense_bias', 'ff_dense1_bias', 'ff_dense2_bias')
+
+
+def quantize_per_channel(array, channel_axis=-1):
+    """
+    Symmetric int8 quantization with one scale per index of `channel_axis`.
+
+    Returns the int8 codes and the float32 scales; `codes * scales` (broadcast along
+    `channel_axis`) restores the array to within half a step.
+    """
+    array = np.asarray(array, dtype=np.float32)
+    channel_axis = channel_axis % array.ndim
+    reduce_axes = tuple(axis for axis in range(array.ndim) if axis != channel_axis)
+    scales = np.abs(array).max(axis=reduce_axes) / 127.0
+    scales[scales == 0] = 1.0
+    shape = [1] * array.ndim
+    shape[channel_axis] = -1
+    codes = np.clip(np.round(array / scales.reshape(shape)), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedTransformerLayer(TransformerLayer):
+    """
+    Inference-only TransformerLayer whose dense kernels are int8 variables with per-output-
+    channel scales. The kernels are dequantized in the compute dtype on every call, so both
+    the original and the fast path of TransformerLayer run unchanged.
+    """
+
+    def build(self, input_shape):
+        input_feat_size = input_shape[-1]
+        for name in FLOAT_WEIGHTS:
+            shape = (1,) if name.startswith('random_id') else (self.depth,)
+            setattr(self, name, self.add_weight(name, shape=shape, initializer=tf.initializers.Zeros(), trainable=False))
+        for name in QUANTIZED_KERNELS:
+            shape = (input_feat_size if name == 'input_dense_weight' else self.depth, self.depth)
+            setattr(self, name + '_codes', self.add_weight(name + '_codes', shape=shape, dtype=tf.int8,
+                                                           initializer=tf.initializers.Zeros(), trainable=False))
+            setattr(self, name + '_scales', self.add_weight(name + '_scales', shape=(self.depth,),
+                                                            initializer=tf.initializers.Ones(), trainable=False))
+        self.built = True
+
+    def _kernel(self, name):
+        codes = getattr(self, name + '_codes')
+        scales = getattr(self, name + '_scales')
+        return tf.cast(codes, self.compute_dtype) * tf.cast(scales, self.compute_dtype)
+
+    input_dense_weight = property(lambda self: self._kernel('input_dense_weight'))
+    query_dense_weight = property(lambda self: self._kernel('query_dense_weight'))
+    key_dense_weight = property(lambda self: self._kernel('key_dense_weight'))
+    value_dense_weight = property(lambda self: self._kernel('value_dense_weight'))
+    dense_weight = property(lambda self: self._kernel('dense_weight'))
+    ff_dense1_weight = property(lambda self: self._kernel('ff_dense1_weight'))
+    ff_dense2_weight = property(lambda self: self._kernel('ff_dense2_weight'))
+
+    def set_quantized(self, arrays, prefix):
+        for name in FLOAT_WEIGHTS:
+            getattr(self, name).assign(arrays[f'{prefix}/{name}'])
+        for name in QUANTIZED_KERNELS:
+            getattr(self, name + '_codes').assign(arrays[f'{prefix}/{name}/codes'])
+            getattr(self, name + '_scales').assign(arrays[f'{prefix}/{name}/scales'])
+
+
+class QuantizedEmbeddingTable:
+    """
+    Int8 embedding table with one scale per token row, with the lookup interface of
+    `EmbeddingTable` (`gather`, `contains`, `token_ids`, `dim`).
+    """
+
+    def __init__(self, token_ids, codes, scales, rows):
+        self.row_ids = np.asarray(token_ids, dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.int8)
+        self.scales = np.asarray(scales, dtype=np.float32)
+        self.rows = int(rows)
+        self.dim = self.codes.shape[1]
+        # token id -> row of `codes`, -1 for tokens without a vector
+        self.row_of = np.full(self.rows, -1, dtype=np.int64)
+        self.row_of[self.row_ids] = np.arange(len(self.row_ids))
+        self.empty_vec = np.zeros(self.dim, dtype=np.float32)
+
+    @classmethod
+    def from_table(cls, table):
+        token_ids = table.token_ids
+        codes, scales = quantize_per_channel(table.gather(token_ids), channel_axis=0)
+        return cls(token_ids, codes, scales, table.rows)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['token_ids'], data['codes'], data['scales'], data['rows'])
+
+    def save(self, path):
+        np.savez(path, token_ids=self.row_ids, codes=self.codes, scales=self.scales, rows=self.rows)
+
+    @property
+    def token_ids(self):
+        return self.row_ids
+
+    def contains(self, token_ids):
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        in_range = (token_ids >= 0) & (token_ids < self.rows)
+        return in_range & (self.row_of[np.where(in_range, token_ids, 0)] >= 0)
+
+    def gather(self, token_ids):
+        """Dequantized vectors of shape (*shape, dim); tokens missing from the table map to `empty_vec`."""
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        found = self.contains(token_ids)
+        rows = self.row_of[np.where(found, token_ids, 0)]
+        vectors = self.codes[rows].astype(np.float32) * self.scales[rows][..., None]
+        vectors[~found] = self.empty_vec
+        return vectors
+
+
+def export_int8_model(model, export_dir, table):
+    """Write `model` and the EmbeddingTable `table` to `export_dir` in the int8 format described above."""
+    os.makedirs(export_dir, exist_ok=True)
+    arrays = {}
+    for layer in model.layers:
+        if isinstance(layer, TransformerLayer):
+            for name in FLOAT_WEIGHTS:
+                arrays[f'{layer.name}/{name}'] = getattr(layer, name).numpy()
+            for name in QUANTIZED_KERNELS:
+                codes, scales = quantize_per_channel(getattr(layer, name).numpy(), channel_axis=-1)
+                arrays[f'{layer.name}/{name}/codes'] = codes
+                arrays[f'{layer.name}/{name}/scales'] = scales
+        else:
+            for i, weight in enumerate(layer.get_weights()):
+                arrays[f'{layer.name}/{i}'] = weight
+    np.savez(os.path.join(export_dir, 'weights.npz'), **arrays)
+    with open(os.path.join(export_dir, 'model.json'), 'w') as f:
+        f.write(model.to_json())
+    QuantizedEmbeddingTable.from_table(table).save(os.path.join(export_dir, 'table.npz'))
+
+
+def load_int8_model(export_dir):
+    """Rebuild an exported model with `QuantizedTransformerLayer` in place of every TransformerLayer."""
+    with open(os.path.join(export_dir, 'model.json'), 'r') as f:
+        model = tf.keras.models.model_from_json(f.read(), custom_objects={'TransformerLayer': QuantizedTransformerLayer})
+    with np.load(os.path.join(export_dir, 'weights.npz')) as data:
+        arrays = dict(data)
+    for layer in model.layers:
+        if isinstance(layer, QuantizedTransformerLayer):
+            layer.set_quantized(arrays, layer.name)
+        elif layer.weights:
+            layer.set_weights([arrays[f'{layer.name}/{i}'] for i in range(len(layer.weights))])
+    return model
+
+
+def weight_bytes(model):
+    return sum(int(np.prod(w.shape)) * w.dtype.size for w in model.weights)
+
+
+def accuracy_report(float_model, int8_model, windows, embed, sequence_size, predict_steps, float_index, int8_index,
+                    batch_size=512):
+    """
+    Compare the int8 export with the float model on fixed (windows, sequence_size + predict_steps)
+    validation spans of token ids, embedded with `embed` in batches.
+
+    Reports the Huber loss of both models against the targets, the mean absolute difference
+    of their predictions, and how often the tokens decoded from them with their own vector
+    index agree with each other and with the target tokens.
+    """
+    totals = {'float_loss': 0.0, 'int8_loss': 0.0, 'prediction_mae': 0.0}
+    agree = float_correct = int8_correct = tokens = 0
+    for start in range(0, len(windows), batch_size):
+        chunk = embed(windows[start:start + batch_size])
+        inputs, targets = chunk[:, :sequence_size], chunk[:, predict_steps:]
+        float_pred = float_model(inputs, training=False).numpy()
+        int8_pred = int8_model(inputs, training=False).numpy()
+        totals['float_loss'] += huber_loss(targets, float_pred) * len(chunk)
+        totals['int8_loss'] += huber_loss(targets, int8_pred) * len(chunk)
+        totals['prediction_mae'] += float(np.abs(float_pred - int8_pred).mean()) * len(chunk)
+
+        float_tokens = float_index.decode(float_pred)
+        int8_tokens = int8_index.decode(int8_pred)
+        target_tokens = float_index.decode(targets)
+        agree += int(np.sum(float_tokens == int8_tokens))
+        float_correct += int(np.sum(float_tokens == target_tokens))
+        int8_correct += int(np.sum(int8_tokens == target_tokens))
+        tokens += target_tokens.size
+
+    report = {name: value / max(1, len(windows)) for name, value in totals.items()}
+    report.update({
+        'windows': len(windows),
+        'token_agreement': agree / max(1, tokens),
+        'float_token_accuracy': float_correct / max(1, tokens),
+        'int8_token_accuracy': int8_correct / max(1, tokens),
+        'float_weight_bytes': weight_bytes(float_model),
+        'int8_weight_bytes': weight_bytes(int8_model),
+    })
+    return report
+
+
+def write_report(export_dir, report):
+    with open(os.path.join(export_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
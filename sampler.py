@@ -0,0 +1,134 @@
+import threading
+
+import numpy as np
+
+
+class WindowSampler:
+    """
+    Deterministic sampler of training windows across many books.
+
+    Window starts are `offset, offset + stride, ...` in every book, numbered globally in
+    book order. Each epoch visits a permutation of all window numbers derived from
+    (seed, epoch) only, so any (epoch, step) cursor can be resumed without replaying the
+    epoch, and only book lengths are needed to plan it.
+
+    Args:
+    - book_lengths (list[int]): Number of tokens of every book.
+    - sequence_size (int): Tokens in an input window.
+    - predict_steps (int): Shift between the input and the target window.
+    - batch_size (int): Windows per batch; the last incomplete batch of an epoch is dropped.
+    - stride (int): Tokens between consecutive window starts in a book.
+    - offset (int): Start of the first window in every book.
+    - seed (int): Seed of the shuffling.
+    - shuffle (bool): Visit windows in a random order, otherwise in book order.
+    - jitter (bool): Move the window grid by a random offset in [0, stride) every epoch.
+    - max_steps (int): Cap on the batches of an epoch, e.g. to keep data-parallel workers in step.
+    """
+
+    def __init__(self, book_lengths, sequence_size, predict_steps, batch_size, stride=1, offset=0,
+                 seed=0, shuffle=True, jitter=False, max_steps=None):
+        self.sequence_size = sequence_size
+        self.predict_steps = predict_steps
+        self.batch_size = batch_size
+        self.stride = stride
+        self.offset = offset
+        self.seed = seed
+        self.shuffle = shuffle
+        self.jitter = jitter
+        self.max_steps = max_steps
+        self.book_lengths = np.asarray(book_lengths, dtype=np.int64)
+        # the last usable start is length - window; jitter needs stride - 1 spare tokens
+        window = sequence_size + predict_steps
+        spare = stride - 1 if jitter else 0
+        usable = self.book_lengths - window - offset - spare
+        self.book_windows = np.where(usable >= 0, usable // stride + 1, 0)
+        self.window_offsets = np.concatenate([[0], np.cumsum(self.book_windows)])
+        self._orders = {}
+        self._orders_lock = threading.Lock()
+
+    def __getstate__(self):
+        # pickled to input worker processes without the cached orders and the lock
+        state = self.__dict__.copy()
+        del state['_orders'], state['_orders_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._orders = {}
+        self._orders_lock = threading.Lock()
+
+    @property
+    def num_windows(self):
+        return int(self.window_offsets[-1])
+
+    @property
+    def steps_per_epoch(self):
+        steps = self.num_windows // self.batch_size
+        return steps if self.max_steps is None else min(steps, self.max_steps)
+
+    def _epoch_rng(self, epoch):
+        return np.random.default_rng([self.seed, epoch])
+
+    def epoch_order(self, epoch):
+        """
+        Window numbers of `epoch` in visiting order. Computed once per epoch and shared by the
+        threads iterating the same sampler; the orders of the two latest epochs are kept, so
+        a thread that is an epoch behind the others does not compute its order again.
+        """
+        with self._orders_lock:
+            order = self._orders.get(epoch)
+            if order is None:
+                if self.shuffle:
+                    order = self._epoch_rng(epoch).permutation(self.num_windows)
+                else:
+                    order = np.arange(self.num_windows, dtype=np.int64)
+                self._orders = {e: o for e, o in self._orders.items() if e == epoch - 1}
+                self._orders[epoch] = order
+            return order
+
+    def epoch_offset(self, epoch):
+        if not self.jitter:
+            return self.offset
+        return self.offset + int(np.random.default_rng([self.seed, epoch, 1]).integers(self.stride))
+
+    def locate(self, window_ids, epoch=0):
+        """Map global window numbers to (book index, start token) arrays."""
+        books = np.searchsorted(self.window_offsets, window_ids, side='right') - 1
+        starts = self.epoch_offset(epoch) + (window_ids - self.window_offsets[books]) * self.stride
+        return books, starts
+
+    def iter_epoch(self, epoch, start_step=0, shard=0, num_shards=1):
+        """
+        Yield (step, book indices, starts) for the batches of `epoch` from `start_step` on;
+        with `num_shards`, only the steps with `step % num_shards == shard` are located.
+        """
+        order = self.epoch_order(epoch)
+        first = start_step + (shard - start_step) % num_shards
+        for step in range(first, self.steps_per_epoch, num_shards):
+            window_ids = order[step * self.batch_size:(step + 1) * self.batch_size]
+            books, starts = self.locate(window_ids, epoch)
+            yield step, books, starts
+
+
+def assemble_batch(book_vectors, books, starts, sequence_size, predict_steps, out=None):
+    """
+    Gather a (batch, sequence_size, dim) input and target batch from several books.
+
+    `book_vectors` holds the converted (tokens, dim) array of every book, e.g. memory-mapped
+    dataset cache entries; windows of the same book are gathered with one fancy index.
+    `out` is an optional (xs, ys) pair of float32 arrays to fill instead of new ones.
+    """
+    if out is not None:
+        xs, ys = out
+    else:
+        dim = book_vectors[books[0]].shape[-1] if len(books) else 0
+        xs = np.empty((len(books), sequence_size, dim), dtype=np.float32)
+        ys = np.empty((len(books), sequence_size, dim), dtype=np.float32)
+    positions = np.arange(sequence_size)
+    for book in np.unique(books):
+        rows = np.flatnonzero(books == book)
+        token_idx = starts[rows, None] + positions
+        vectors = book_vectors[book]
+        xs[rows] = vectors[token_idx]
+        ys[rows] = vectors[token_idx + predict_steps]
+    return xs, ys
@@ -0,0 +1,174 @@
+import argparse
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from inference import InferenceEngine
+
+
+class DynamicBatcher:
+    """
+    Coalesces concurrent generation requests into batched forward passes.
+
+    A background thread waits for the first queued request, then keeps collecting until
+    `max_batch_size` requests are queued or `max_latency_ms` have passed, and generates
+    all of them together. Requests with the same sampling settings share one
+    `InferenceEngine.generate` call, so the forward pass and the nearest-neighbour decode
+    run once per batch instead of once per request.
+    """
+
+    def __init__(self, engine, max_batch_size=32, max_latency_ms=10.0):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.batch_sizes = []
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt_tokens, num_tokens, top_k=1, temperature=1.0):
+        """Queue a request; the returned Future resolves to (token ids, info)."""
+        future = Future()
+        self.requests.put((time.perf_counter(), list(prompt_tokens), num_tokens, top_k, temperature, future))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            groups = {}
+            for request in batch:
+                groups.setdefault((request[3], request[4]), []).append(request)
+            for (top_k, temperature), requests in groups.items():
+                try:
+                    num_tokens = max(request[2] for request in requests)
+                    generated, _ = self.engine.generate([request[1] for request in requests], num_tokens,
+                                                        top_k=top_k, temperature=temperature)
+                except Exception as e:
+                    logging.error(f"Batch of {len(requests)} requests failed: {e}")
+                    for request in requests:
+                        request[5].set_exception(e)
+                    continue
+                done = time.perf_counter()
+                with self.lock:
+                    self.batch_sizes.append(len(requests))
+                    for request, tokens in zip(requests, generated):
+                        latency = done - request[0]
+                        self.latencies.append(latency)
+                        request[5].set_result((tokens[:request[2]].tolist(), {'latency_ms': latency * 1000.0, 'batch_size': len(requests)}))
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies[-1000:]) * 1000.0
+            batch_sizes = np.array(self.batch_sizes[-1000:])
+            completed = len(self.latencies)
+        return {
+            'queue_depth': self.requests.qsize(),
+            'completed': completed,
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.0,
+            'latency_ms_p50': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            'latency_ms_p95': float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+        }
+
+
+def handle_request(batcher, request):
+    """Run one JSON request {"prompt", "tokens", "top_k", "temperature"} and build its JSON reply."""
+    tokenizer = batcher.engine.tokenizer
+    future = batcher.submit(tokenizer.encode(request.get('prompt', '')), int(request.get('tokens', 32)),
+                            top_k=int(request.get('top_k', 1)), temperature=float(request.get('temperature', 1.0)))
+    tokens, info = future.result()
+    return {'text': tokenizer.decode(tokens), 'tokens': tokens, **info}
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                self._reply(404, {'error': 'not found'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                self._reply(200, handle_request(batcher, request))
+            except Exception as e:
+                self._reply(400, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
+
+
+def serve_stdin(batcher):
+    """Read one request per line (JSON or a plain prompt), answer them concurrently, print replies in order."""
+    lines = [line.strip() for line in sys.stdin if line.strip()]
+    requests = [json.loads(line) if line.startswith('{') else {'prompt': line} for line in lines]
+    replies = [None] * len(requests)
+
+    def worker(i):
+        replies[i] = handle_request(batcher, requests[i])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for reply in replies:
+        print(json.dumps(reply))
+    print(json.dumps(batcher.stats()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Local dynamic-batching inference server.')
+    parser.add_argument('--model-id', default='512_512', help="model directory suffix, ./models/llm_{model_id}")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-latency-ms', type=float, default=10.0)
+    parser.add_argument('--stdin', action='store_true', help='answer requests read from stdin instead of serving HTTP')
+    parser.add_argument('--int8', action='store_true', help='serve the int8 export ./models/llm_{model_id}_int8')
+    args = parser.parse_args()
+
+    engine = InferenceEngine(f"./models/llm_{args.model_id}{'_int8' if args.int8 else ''}", int8=args.int8)
+    batcher = DynamicBatcher(engine, args.max_batch_size, args.max_latency_ms)
+    if args.stdin:
+        serve_stdin(batcher)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+        logging.info(f"Serving on http://{args.host}:{args.port} (POST /generate, GET /stats)")
+        server.serve_forever()
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+TOKEN_DTYPE = np.uint32
+# start a new shard once the current one holds this many tokens
+MAX_SHARD_TOKENS = 64 * 1024 * 1024
+
+
+def content_hash(file_path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def list_books(directory):
+    """Text files under `directory`, relative to it, in a stable order."""
+    return sorted(
+        os.path.relpath(os.path.join(root, file), directory)
+        for root, dirs, files in os.walk(directory) for file in files if file.endswith('.txt'))
+
+
+class TokenStore:
+    """
+    Tokenized corpus stored as fixed-width uint32 shards plus a JSON index.
+
+    The index maps every book (path relative to the data directory) to its shard,
+    token offset, token length and the sha1 of the text it was tokenized from, and,
+    after deduplication, the token ranges that are kept. Books that are copies of an
+    earlier book are listed under 'duplicates' instead and never tokenized.
+    Shards are memory-mapped on first use, so reading a book never copies it.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = {'version': 1, 'shards': [], 'books': {}}
+        index_path = os.path.join(store_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self.index = json.load(f)
+        self._shards = {}
+
+    @property
+    def books(self):
+        return self.index['books']
+
+    def __contains__(self, book):
+        return book in self.books
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            path = os.path.join(self.store_dir, self.index['shards'][shard])
+            self._shards[shard] = np.memmap(path, dtype=TOKEN_DTYPE, mode='r') if os.path.getsize(path) else np.empty(0, dtype=TOKEN_DTYPE)
+        return self._shards[shard]
+
+    def get(self, book):
+        """Tokens of `book` as a read-only uint32 view, or None if the book is not stored."""
+        entry = self.books.get(book)
+        if entry is None:
+            return None
+        return self._shard(entry['shard'])[entry['offset']:entry['offset'] + entry['length']]
+
+    def get_kept(self, book):
+        """Tokens of `book` left by deduplication (see dedup.py), or None if the book is not stored."""
+        tokens = self.get(book)
+        keep = self.books[book].get('keep') if tokens is not None else None
+        if keep is None:
+            return tokens
+        return np.concatenate([tokens[start:end] for start, end in keep] or [tokens[:0]])
+
+    def kept_length(self, book):
+        entry = self.books[book]
+        keep = entry.get('keep')
+        return entry['length'] if keep is None else sum(end - start for start, end in keep)
+
+    def save_index(self):
+        index_path = os.path.join(self.store_dir, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(index_path + '.tmp', index_path)
+
+
+class ShardWriter:
+    """Appends token arrays to new shards of a `TokenStore` and records them in its index."""
+
+    def __init__(self, store, max_shard_tokens=MAX_SHARD_TOKENS):
+        self.store = store
+        self.max_shard_tokens = max_shard_tokens
+        self.file = None
+        self.shard = None
+        self.offset = 0
+
+    def _open_shard(self):
+        self.close()
+        shards = self.store.index['shards']
+        self.shard = len(shards)
+        name = f'shard_{self.shard:05d}.bin'
+        shards.append(name)
+        self.file = open(os.path.join(self.store.store_dir, name), 'wb')
+        self.offset = 0
+
+    def add_file(self, book, part_path, book_hash):
+        """Append a file of raw uint32 tokens without loading it into memory."""
+        length = os.path.getsize(part_path) // np.dtype(TOKEN_DTYPE).itemsize
+        if self.file is None or (self.offset and self.offset + length > self.max_shard_tokens):
+            self._open_shard()
+        with open(part_path, 'rb') as part_f:
+            shutil.copyfileobj(part_f, self.file)
+        self.store.books[book] = {'shard': self.shard, 'offset': self.offset, 'length': length, 'hash': book_hash}
+        self.offset += length
+
+    def sync(self):
+        """Make the written tokens durable before the index starts pointing at them."""
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+def compact_store(store):
+    """Delete shard files no book points at any more."""
+    used = {entry['shard'] for entry in store.books.values()}
+    for shard, name in enumerate(store.index['shards']):
+        path = os.path.join(store.store_dir, name)
+        if shard not in used and os.path.exists(path):
+            os.remove(path)
+            logging.info(f"Removed unused shard {name}")
@@ -1,479 +1,456 @@
-# 287 line test tokenizer. Ensure that all tokens are present in vec.vec
-# for book_path in books:
-#     full_path = os.path.join('./data', book_path)
-#     with open(full_path, 'r') as f:
-#         book = f.read()
-#     book = tokenizer.encode(book)
-
-#     for token in book:
-#         assert convert(token) != empty_vec, f"token {token} hasn't been found in w2v: {w2v}"
-
-
-import tensorflow as tf
-import tiktoken
+"""
+Train, evaluate and sample from the model.
+
+    python train.py train --set batchSize=512 --set precisionPolicy=mixed_bfloat16
+    python train.py train --workers 4  # data-parallel over 4 local processes
+    python train.py eval --iters 20
+    python train.py generate --prompt "Once upon a time" --tokens 64
+    python train.py bench --skip-layer
+
+Importing this module has no side effects: the embedding table, token store and dataset
+cache are opened on first use by `pipeline`, the model and optimizer are built by `run`.
+`--set key=value` overrides `config.cfg` before anything is built.
+"""
+import argparse
+import json
+import logging
 import os
 import random
-import numpy as np
-import math
-from datetime import datetime
+import sys
 import time
-import json
-import logging
-import pickle
-
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
-
-use_gpu = True
-if not use_gpu:
-    # seems to be better for M1 Macbook with the current architecture
-    tf.config.experimental.set_visible_devices([], 'GPU')
-
-# Default checkpoint data
-checkpoint_data = {
-    'last_epoch': 0,
-    'other_data': None  # You can add other data if needed
-}
-
-def setattr_time(epoch_start_time):
-    setattr(time, 'epoch_start_time', epoch_start_time)
-
-
-cfg = {
-    'sequenceSize': 512,
-    'dimension': 512,
-    'arrayDimension': 8,
-    'predictSteps': 8,
-    'batchSize': 2048
-}
-learning_rate = 0.0005
-model_id = f"{cfg['sequenceSize']}_{cfg['dimension']}"
-model_path = f'./models/llm_{model_id}'
-checkpoint_path = f'checkpoint_{model_id}.txt'
-wandb_log = True  # disabled by default
-wandb_project = "fast-model"
-wandb_run_name = f"run_combined_{model_id} {datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}"
-if wandb_log:
-    import wandb
-    wandb.init(project=wandb_project, name=wandb_run_name, config=cfg, resume=True)
-
-if os.path.exists(checkpoint_path):
-    with open(checkpoint_path, 'r') as file:
-        checkpoint_data = json.load(file)
-
-last_epoch = checkpoint_data['last_epoch']
-
-max_iters = 10000
-initial_learning_rate = learning_rate
-decay_steps = max_iters - checkpoint_data['last_epoch']
-decay_rate = 0.96
-
-lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
-    initial_learning_rate,
-    decay_steps=decay_steps,
-    decay_rate=decay_rate,
-    staircase=True)  # If True, decay the learning rate at discrete intervals
-
-# WARNING:absl:At this time, the v2.11+ optimizer `tf.keras.optimizers.Adam` runs slowly on M1/M2 Macs, please use the legacy Keras optimizer instead, located at `tf.keras.optimizers.legacy.Adam`.
-optimizer = tf.keras.optimizers.legacy.Adam(learning_rate=lr_schedule)
-
-#optimizer = tf.keras.optimizers.Adam(learning_rate=lr_schedule)
-
-class TransformerLayer(tf.keras.layers.Layer):
-    def __init__(self, num_heads=8, pad_size=None, depth=None, pool=None, **kwargs):
-        super(TransformerLayer, self).__init__(**kwargs)
-        self.num_heads = num_heads
-        self.depth = depth
-        self.pool = pool
-        self.pad_size = pad_size
-        self.DEFAULT_KERNEL_INITIALIZER = "glorot_normal"
-        
-        if self.depth % self.num_heads != 0:
-            raise ValueError(f"Error: depth({self.depth}) % numHead({self.num_heads}) != 0")
-
-    def build(self, input_shape):
-        input_feat_size = input_shape[-1]
-        
-        self.random_id_att = self.add_weight("random_id_att", shape=(1,), initializer=tf.initializers.Zeros())
-        self.random_id_ff = self.add_weight("random_id_ff", shape=(1,), initializer=tf.initializers.Zeros())
-        
-        # Define other weights
-        self.input_dense_weight = self.add_weight("input_dense_weight", shape=(input_feat_size, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.input_dense_bias = self.add_weight("input_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.query_dense_weight = self.add_weight("query_dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.query_dense_bias = self.add_weight("query_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.key_dense_weight = self.add_weight("key_dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.key_dense_bias = self.add_weight("key_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.value_dense_weight = self.add_weight("value_dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.value_dense_bias = self.add_weight("value_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.dense_weight = self.add_weight("dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.dense_bias = self.add_weight("dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.ff_dense1_weight = self.add_weight("ff_dense1_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.ff_dense1_bias = self.add_weight("ff_dense1_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.ff_dense2_weight = self.add_weight("ff_dense2_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        self.ff_dense2_bias = self.add_weight("ff_dense2_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
-        
-        self.built = True
-
-    def call(self, inputs):
-        K = tf
-        # logging.debug(f"Shape of inputs: {inputs.shape}")
-        batch_size = tf.shape(inputs)[0]
-        
-        flat_input = tf.reshape(inputs, [self.pad_size * batch_size, -1])
-        flat_scaled_input = tf.matmul(flat_input, self.input_dense_weight) + self.input_dense_bias
-        scaled_input = tf.reshape(flat_scaled_input, [batch_size, self.pad_size, -1])
-        # logging.debug("Shape of scaledInput:", scaled_input.shape)
-
-        flat_query = tf.matmul(flat_scaled_input, self.query_dense_weight) + self.query_dense_bias
-        flat_key = tf.matmul(flat_scaled_input, self.key_dense_weight) + self.key_dense_bias
-        flat_value = tf.matmul(flat_scaled_input, self.value_dense_weight) + self.value_dense_bias
-
-        query = tf.reshape(flat_query, [batch_size, self.pad_size, -1])
-        key = tf.reshape(flat_key, [batch_size, self.pad_size, -1])
-        value = tf.reshape(flat_value, [batch_size, self.pad_size, -1])
-
-        query_t = tf.transpose(tf.reshape(query, [batch_size, -1, self.num_heads, self.depth // self.num_heads]), [0, 2, 1, 3])
-        key_t = tf.transpose(tf.reshape(key, [batch_size, -1, self.num_heads, self.depth // self.num_heads]), [0, 2, 1, 3])
-        value_t = tf.transpose(tf.reshape(value, [batch_size, -1, self.num_heads, self.depth // self.num_heads]), [0, 2, 1, 3])
-        logging.debug(f"Shape of queryT: {query_t.shape}")
-        logging.debug(f"Shape of keyT: {key_t.shape}")
-        logging.debug(f"Shape of valueT: {value_t.shape}")
-
-        matmul_qk = tf.matmul(query_t, key_t, transpose_b=True)
-        logits = matmul_qk / tf.sqrt(tf.cast(self.depth, tf.float32))
-        logging.debug(f"Shape of logits before addition: {logits.shape}")
-        
-        to_broadcast_mask = tf.ones([batch_size, self.num_heads, self.pad_size, self.pad_size])
-        logging.debug(f"Shape of to_broadcast_mask: {to_broadcast_mask.shape}")
-        logits += (1.0 - to_broadcast_mask) * -1e9
-
-        attention_weights = tf.nn.sigmoid(logits) * tf.nn.tanh(logits)
-        scaled_attention = tf.matmul(attention_weights, value_t)
-        
-        scaled_attention_t = tf.transpose(scaled_attention, [0, 2, 1, 3])
-        concat_attention = tf.reshape(scaled_attention_t, [batch_size, -1, self.depth])
-        flatten_concat_attention = tf.reshape(concat_attention, [batch_size * self.pad_size, -1])
-        flatten_attention = tf.matmul(flatten_concat_attention, self.dense_weight) + self.dense_bias
-        attention = tf.reshape(flatten_attention, [batch_size, self.pad_size, -1])
-        logging.debug(f"Shape of attention: {attention.shape}")
-
-        normalized_latent = scaled_input + tf.squeeze(self.random_id_att) * attention
-        flatten_normalized_latent = tf.reshape(normalized_latent, [batch_size * self.pad_size, -1])
-        
-        flat_ff1 = tf.matmul(flatten_normalized_latent, self.ff_dense1_weight) + self.ff_dense1_bias
-        flat_rff1 = tf.nn.leaky_relu(flat_ff1)
-        flat_ff2 = tf.matmul(flat_rff1, self.ff_dense2_weight) + self.ff_dense2_bias
-        flat_dff2 = tf.nn.dropout(flat_ff2, 0.1)
-        dff2 = tf.reshape(flat_dff2, [batch_size, self.pad_size, -1])
-
-        output = normalized_latent + tf.squeeze(self.random_id_ff) * dff2
-        output = tf.reshape(output, [batch_size, self.pad_size, self.depth])
-        logging.debug("Return output")
-        if self.pool:
-            return tf.reduce_mean(output, axis=1)
-        else:
-            return output
-
-
-    def compute_output_shape(self, input_shape):
-        if self.pool:
-            return (input_shape[0], self.depth)
-        else:
-            return (input_shape[0], input_shape[1], self.depth)
-
-    def get_config(self):
-        config = super(TransformerLayer, self).get_config()
-        config.update({
-            'pool': self.pool,
-            'pad_size': self.pad_size,
-            'num_heads': self.num_heads,
-            'depth': self.depth
-        })
-        return config
-
-def addler(data, mod):
-    MOD_ADLER = mod
-    a, b = 1, 0
-
-    for value in data:
-        a = (a + value) % MOD_ADLER
-        b = (b + a) % MOD_ADLER
-
-    return b
-
-words = {}
-maxf = 0
-
-# Get all files under './data' directory, excluding .DS_Store files
-books = [os.path.join(root, file) for root, dirs, files in os.walk('./data') for file in files if not file.endswith('.DS_Store')]
-
-# Shuffle the list
-random.shuffle(books)
-books
-
-# Read the file
-with open('./models/vec.vec', 'r') as f:
-    v = f.readlines()
-
-v.pop(0)  # Remove the first line
-w2v = {}
-
-for line in v:
-    tokens = line.split()
-    key = tokens.pop(0)
-    vec = [float(token) for token in tokens if token]
-    w2v[key] = vec
-
-vw2v = list(w2v.items())
-vw2v
-
-# Initialize the encoding
-tokenizer = tiktoken.encoding_for_model("gpt-4")
+from datetime import datetime
 
-def estimate_mfu(model, fwdbwd_per_iter, dt):
-    """Estimate model flops utilization (MFU) in units of A100 bfloat16 peak FLOPS."""
-    N = sum(np.prod(v.shape) for v in model.trainable_variables)
-    
-    L = cfg['sequenceSize']  # Number of layers
-    H = cfg['dimension'] // cfg['sequenceSize']  # Number of heads
-    Q = cfg['sequenceSize']  # Dimension per head
-    T = cfg['sequenceSize']  # Max sequence length
-    
-    flops_per_token = 6*N + 12*L*H*Q*T
-    flops_per_fwdbwd = flops_per_token * T
-    flops_per_iter = flops_per_fwdbwd * fwdbwd_per_iter
-    
-    # express our flops throughput as a ratio of A100 bfloat16 peak flops
-    flops_achieved = flops_per_iter * (1.0/dt)  # per second
-    flops_promised = 312e12  # A100 GPU bfloat16 peak flops is 312 TFLOPS
-    
-    mfu = flops_achieved / flops_promised
-    return mfu
+import numpy as np
+import tensorflow as tf
 
+from checkpointing import AsyncCheckpointer, CheckpointCallback
+from config import apply_overrides, cfg, model_paths
+from distributed import export_model, launch_local_workers, shard_books, worker_context
+from input_workers import SHM_DIR, ParallelBatchLoader, fit_ring, ring_bytes, shm_free_bytes
+from model import ThroughputCallback, load_or_build_model, make_optimizer
+from pipeline import (TABLE_PATH, TOKENS_DIR, VEC_PATH, VOCAB_PATH, book_hash, book_length, convert,
+                      get_dataset_cache, get_embedding_table, get_tokenizer, get_vector_index, list_books,
+                      load_book_vectors, profiler, reparse, reverser, tokenize_book, train_val_split)
+from sampler import WindowSampler, assemble_batch
+from token_store import TOKEN_DTYPE
+from transformer import TransformerLayer
+from validation import BackgroundEvaluator, evaluate_windows, sample_validation_windows, validation_key
 
-def reparse(v):
-    v = [int(reverser(item)) if len(item) else item for item in v]
-    return tokenizer.decode(v)
+logger = logging.getLogger(__name__)
 
-import numpy as np
+wandb_project = "fast-model"
 
-def reverser(arr):
-    arr_np = np.array(arr)
-    vectors = np.array([item[1] if item[1] else [0] * 8 for item in vw2v])
-    distances = np.linalg.norm(vectors - arr_np, axis=1)
-    min_index = np.argmin(distances)
-    return vw2v[min_index][0]
-
-# Assuming w2v is a dictionary defined globally
-empty_vec = [0] * 8
-def convert(n):
-    vec = w2v.get(str(n), empty_vec)
-    if vec == empty_vec:
-        logging.error(f"Token {n} not found in w2v dictionary!")
-    return [float(i) for i in vec]
-
-assert convert(11) != empty_vec
-
-books = [file for file in os.listdir('./data') if file.endswith('.txt') and not file.startswith('.DS_Store')]
-random.shuffle(books)
-
-# Split into train and test based on hashes derived from the filenames
-# in this way, we can add/remove new files and train/test files will not be mixed
-import hashlib
-
-def hash_based_split(filenames, test_split=0.2):
-    train_files = []
-    test_files = []
-    for filename in filenames:
-        hash_val = hashlib.md5(filename.encode()).hexdigest()
-        hash_num = int(hash_val, 16) / float(1 << 128)
-        if hash_num < test_split:
-            test_files.append(filename)
-        else:
-            train_files.append(filename)
-    return train_files, test_files
-
-train_books, val_books = hash_based_split(books, test_split=0.2)
-logging.info(f"Found train books: {len(train_books)}, test books: {len(val_books)}")
-
-def estimate_loss(model, dataset, eval_iters=100):
-    losses = []
-    dataset_iter = iter(dataset)
-
-    for k in range(eval_iters):
-        X, Y = next(dataset_iter)
-        logits = model(X, training=False)
-        # Using Huber loss from TensorFlow
-        loss_value = tf.keras.losses.Huber()(Y, logits)
-        losses.append(loss_value.numpy())
-    
-    return np.mean(losses)
+def load_checkpoint_data(checkpoint_path):
+    # Default checkpoint data
+    checkpoint_data = {
+        'last_epoch': 0,
+        'other_data': None  # You can add other data if needed
+    }
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as file:
+            checkpoint_data = json.load(file)
+    return checkpoint_data
+
+def validation_entry(val_books):
+    """Dataset cache (name, hash) of the validation windows of `val_books`."""
+    return VALIDATION_ENTRY, validation_key(val_books, [book_hash(book_path) for book_path in val_books], cfg)
+
+def load_validation_windows(val_books):
+    """Token ids of the validation windows sampled once from `val_books` and kept in the dataset cache."""
+    def build():
+        val_tokens = [tokenize_book(book_path) for book_path in val_books]
+        return sample_validation_windows(val_tokens, cfg['sequenceSize'], cfg['predictSteps'], cfg['valWindows'],
+                                         stride=cfg['windowStride'], seed=cfg['shuffleSeed'] + 1)
+    name, key = validation_entry(val_books)
+    windows = get_dataset_cache().get(name, key, build, dtype=TOKEN_DTYPE)
+    logging.info(f"Validation set: {len(windows)} windows from {len(val_books)} books")
+    return windows
+
+def decode_samples(model, batch_x, batch_y, num_samples):
+    """Decode `num_samples` random windows of a batch; returns their inputs, predicted and real token ids."""
+    samples = sorted(random.sample(range(len(batch_x)), min(num_samples, len(batch_x))))
+    tx11 = batch_x[samples]
+    ty11 = batch_y[samples]
+
+    # one forward pass and one batched index lookup for all sampled windows; a direct call
+    # instead of model.predict, which would wait for the other workers of a cluster
+    res = model(tx11, training=False).numpy()
+    return tx11, reverser(res), reverser(ty11)
 
-setx = []
 last_batch = []
-def run():
+VALIDATION_ENTRY = '<validation>'
+
+def make_sampler(book_lengths, seed, batch_size=None, max_steps=None):
+    return WindowSampler(book_lengths, cfg['sequenceSize'], cfg['predictSteps'], batch_size or cfg['batchSize'],
+                         stride=cfg['windowStride'], seed=seed, jitter=cfg['windowStride'] > 1, max_steps=max_steps)
+
+def generator(shard, num_shards, sampler, book_vectors, start_epoch, start_step):
+    logging.debug(f'Entered generator function. shard: {shard}')
+    global last_batch
+
+    if sampler.steps_per_epoch == 0:
+        logging.warning('Not enough windows for a single batch, generator is empty.')
+        return
+    # windows from many books per batch, gathered from the memory-mapped dataset cache
+    epoch = start_epoch
+    while True:
+        for step, books, starts in sampler.iter_epoch(epoch, start_step if epoch == start_epoch else 0, shard, num_shards):
+            with profiler.stage('batch_assembly'):
+                tx1, ty1 = assemble_batch(book_vectors, books, starts, cfg['sequenceSize'], cfg['predictSteps'])
+            if step % 10 == 0:
+                logging.debug(f'Iterating...epoch: {epoch}, step: {step}')
+            last_batch = (tx1, ty1)
+            wait_start = time.perf_counter()
+            yield tx1, ty1
+            profiler.add('queue_wait', time.perf_counter() - wait_start)
+        epoch += 1
+
+def worker_generator(sampler, book_vectors, start_epoch, start_step, num_workers, slots_per_worker=2):
+    global last_batch
+
+    if sampler.steps_per_epoch == 0:
+        logging.warning('Not enough windows for a single batch, generator is empty.')
+        return
+    # the dataset cache entries are memory-mapped .npy files the workers open themselves
+    loader = ParallelBatchLoader([v.filename for v in book_vectors], sampler, num_workers, start_epoch, start_step,
+                                 slots_per_worker)
+    assembled = 0.0
+    try:
+        for tx1, ty1 in loader:
+            total = loader.total_assembly_seconds()
+            profiler.add('batch_assembly', total - assembled)
+            assembled = total
+            # the batch lives in a shared-memory slot that is reused, keep a copy of the decode samples
+            last_batch = (tx1[:cfg['decodeSamples']].copy(), ty1[:cfg['decodeSamples']].copy())
+            wait_start = time.perf_counter()
+            yield tx1, ty1
+            profiler.add('queue_wait', time.perf_counter() - wait_start)
+    finally:
+        loader.close()
+
+def make_dataset(sampler, book_vectors, start_epoch, start_step=0, input_workers=0):
+    batch_spec = tf.TensorSpec(shape=(sampler.batch_size, cfg['sequenceSize'], cfg['predictSteps']), dtype=tf.float32)
+    if input_workers > 0:
+        # the ring of batch slots lives in /dev/shm, which can be as small as 64 MB in a container
+        slot_shape, slots_per_worker = tuple(batch_spec.shape), 2
+        free = shm_free_bytes()
+        if free is not None:
+            workers, slots = fit_ring(slot_shape, input_workers, slots_per_worker, free)
+            if not workers:
+                logging.warning(f"A batch of {ring_bytes(slot_shape, 1) / 2**20:.1f} MB does not fit in half of the "
+                                f"{free / 2**20:.1f} MB free in {SHM_DIR}, assembling batches in-process instead of in "
+                                f"{input_workers} input workers; enlarge {SHM_DIR} (docker --shm-size) or lower batchSize")
+            elif (workers, slots) != (input_workers, slots_per_worker):
+                logging.warning(f"Input worker ring reduced to {workers} workers x {slots} slots "
+                                f"({ring_bytes(slot_shape, workers * slots) / 2**20:.1f} MB) to fit the "
+                                f"{free / 2**20:.1f} MB free in {SHM_DIR}")
+            input_workers, slots_per_worker = workers, slots
+    if input_workers > 0:
+        # batches come ready from worker processes in step order, one Python generator only copies them
+        return tf.data.Dataset.from_generator(
+            lambda: worker_generator(sampler, book_vectors, start_epoch, start_step, input_workers, slots_per_worker),
+            output_signature=(batch_spec, batch_spec))
+
+    # shard k produces steps k, k + n, ...; a deterministic round-robin interleave restores the step order
+    num_shards = cfg['cacheInterleave']
+    return tf.data.Dataset.range(num_shards).interleave(
+        lambda shard: tf.data.Dataset.from_generator(
+            lambda shard: generator(shard, num_shards, sampler, book_vectors, start_epoch, start_step),
+            args=(shard,), output_signature=(batch_spec, batch_spec)),
+        cycle_length=num_shards,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=True)
+
+def run(wandb_log=True):
     logging.debug('Starting run function.')
-    input = tf.keras.layers.Input(shape=(cfg['sequenceSize'], cfg['predictSteps']))
-
-    x = tf.keras.layers.Permute((2, 1))(input)
-    logging.debug(f"Shape of x after permute: {x.shape}")
-    skip = x
-
-    x = tf.keras.layers.Conv1D(filters=cfg['dimension'], kernel_size=1, strides=1, padding="same", activation="mish")(x)
-    logging.debug(f"Shape of x after Conv1D: {x.shape}")
-    x = TransformerLayer(depth=cfg['dimension'], num_heads=4, pad_size=cfg['arrayDimension'])(x)
-    logging.debug(f"Shape of x after first TransformerLayer: {x.shape}")
-    x = TransformerLayer(depth=cfg['sequenceSize'], num_heads=4, pad_size=cfg['arrayDimension'])(x)
-    logging.debug(f"Shape of x after second TransformerLayer: {x.shape}")
-
-    x3a = tf.keras.layers.Permute((2, 1))(x)
-    x1 = tf.keras.layers.Dense(units=cfg['arrayDimension'], activation="linear")(x3a)
-
-    # Check if saved model exists
-    if os.path.exists(model_path):
-        model = tf.keras.models.load_model(model_path)
-        logging.info("Loaded model from disk.")
+    # one replica per worker process; the strategy must exist before any other TensorFlow op
+    worker_index, num_workers = worker_context()
+    is_chief = worker_index == 0
+    strategy = tf.distribute.MultiWorkerMirroredStrategy() if num_workers > 1 else tf.distribute.get_strategy()
+    wandb_log = wandb_log and is_chief
+    # creating the global generator is a broadcast in a cluster, so every worker creates it
+    # now instead of only the chief in its first checkpoint
+    tf.random.get_global_generator()
+
+    paths = model_paths(cfg)
+    model_id, model_path, checkpoint_path = paths['model_id'], paths['model_path'], paths['checkpoint_path']
+    checkpoint_data = load_checkpoint_data(checkpoint_path)
+    last_epoch = checkpoint_data['last_epoch']
+    if wandb_log:
+        import wandb
+        wandb_run_name = f"run_combined_{model_id} {datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}"
+        wandb.init(project=wandb_project, name=wandb_run_name, config=cfg, resume=True)
+
+    books = list_books()
+    train_books, val_books = train_val_split(books)
+    # from the whole train split, so every worker runs the same number of epochs
+    epochs = max(1, len(train_books) // 128)
+
+    tf.keras.mixed_precision.set_global_policy(cfg['precisionPolicy'])
+    with strategy.scope():
+        model = load_or_build_model(cfg, model_path, make_optimizer(cfg['learningRate'], last_epoch))
+    if is_chief:
+        model.summary()
+        get_dataset_cache().prune([(book_path, book_hash(book_path)) for book_path in books] + [validation_entry(val_books)])
+
+    # every worker trains on its own share of the train books with batchSize / workers windows
+    # per step; all of them stop an epoch after the steps of the smallest share
+    if num_workers > 1:
+        lengths = [book_length(book_path) for book_path in train_books]
+        book_shards = shard_books(train_books, lengths, num_workers)
+        worker_batch = cfg['batchSize'] // num_workers
+        seeds = [cfg['shuffleSeed'] + 2 * shard for shard in range(num_workers)]
+        length_of = dict(zip(train_books, lengths))
+        steps_per_epoch = min(make_sampler([length_of[book_path] for book_path in shard], seed, worker_batch).steps_per_epoch
+                              for shard, seed in zip(book_shards, seeds))
+        train_books = book_shards[worker_index]
+        logging.info(f"Worker {worker_index}/{num_workers}: {len(train_books)} train books, {steps_per_epoch} steps per epoch")
     else:
-        model = tf.keras.Model(inputs=[input], outputs=[x1])
-        model.compile(loss=tf.keras.losses.Huber(), metrics=['accuracy'], optimizer=optimizer)
-    model.summary()
-
+        worker_batch, seeds, steps_per_epoch = cfg['batchSize'], [cfg['shuffleSeed']], None
+    if cfg['microBatchSize'] and worker_batch % cfg['microBatchSize']:
+        raise ValueError(f"microBatchSize {cfg['microBatchSize']} does not divide the batch of {worker_batch} windows per worker")
+    train_vectors = [load_book_vectors(book_path) for book_path in train_books]
+    train_sampler = make_sampler([len(v) for v in train_vectors], seeds[worker_index], worker_batch, steps_per_epoch)
+    steps_per_epoch = train_sampler.steps_per_epoch
+
+    # resume weights, optimizer slots, RNG state and the data cursor from the newest checkpoint;
+    # every worker restores, only the chief writes
+    checkpointer = AsyncCheckpointer(paths['checkpoint_dir'], keep=cfg['checkpointKeep'])
+    initial_step = 0
+    cursor = {'epoch': last_epoch, 'step': 0}
+    latest_checkpoint = checkpointer.latest()
+    if latest_checkpoint:
+        with strategy.scope():
+            state = checkpointer.restore(model, latest_checkpoint)
+        initial_step = state['step']
+        cursor = state['cursor']
+        logging.info(f"Resuming data pipeline at epoch {cursor['epoch']}, step {cursor['step']}")
+
+    def checkpoint_state(step):
+        position = cursor['epoch'] * steps_per_epoch + cursor['step'] + step - initial_step
+        return {
+            'cursor': {'epoch': position // steps_per_epoch, 'step': position % steps_per_epoch},
+            'last_epoch': checkpoint_data['last_epoch'],
+        }
+
+    def train_dataset_fn(input_context=None):
+        dataset = make_dataset(train_sampler, train_vectors, cursor['epoch'], cursor['step'], cfg['inputWorkers'])
+        return dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+    # each worker feeds its replica from its own input pipeline, nothing is auto-sharded
+    if num_workers > 1:
+        train_dataset = strategy.distribute_datasets_from_function(train_dataset_fn)
+    else:
+        train_dataset = train_dataset_fn()
 
-    def generator(book_paths, is_training_dataset):
-        logging.debug(f'Entered generator function. is_training_dataset: {is_training_dataset}')
-        global setx
-        global last_batch
+    # validation runs on the chief only, always on the same windows, so losses are comparable across runs
+    val_windows = load_validation_windows(val_books) if is_chief else []
+    evaluator = None
+    if len(val_windows) and cfg['valBackground']:
+        evaluator = BackgroundEvaluator(model, val_windows, convert, cfg['sequenceSize'], cfg['predictSteps'],
+                                        cfg['valBatchSize'])
 
-        for book_path in book_paths:
-            
-            try:
-                tokenized_book_path = os.path.join('./tokenized_books', os.path.basename(book_path) + '.tokenized.pkl')
-                with open(tokenized_book_path, 'rb') as f:
-                    book = pickle.load(f)
-            except:
-                logging.warning(f'Could not load tokenized book {book_path}, will perform tokenization')
-                full_path = os.path.join('./data', book_path)
-                with open(full_path, 'r') as f:
-                    book = f.read()
-                book = tokenizer.encode(book)
-        
-            setx = []
-            n = 0
-            for _ in range(len(book) // cfg['batchSize']):
-                for k in range(cfg['batchSize']):
-                    pool_slice = book[n + k: k + n + cfg['sequenceSize'] + cfg['predictSteps']]
-                    # logging.debug(f'len pool_slise: {len(pool_slice)}')
-                    # logging.debug(f'pool size first five elements: {pool_slice[:5]}')
-                    xs = pool_slice[:cfg['sequenceSize']]
-                    ys = pool_slice[-cfg['sequenceSize']:]
-
-                    # logging.debug(f'xs shape: {np.array(xs).shape}, ys shape: {np.array(ys).shape}')
-                    # logging.debug(f'xs start: {xs[:10]}, ys start: {ys[:10]}')
-                    
-                    xs_converted = np.array(list(map(convert, xs)), dtype=np.float32)
-                    ys_converted = np.array(list(map(convert, ys)), dtype=np.float32)
-                                            
-                    setx.append([xs_converted, ys_converted])
-                    # logging.debug(f'xs_converted len: {len(xs_converted)}, ys_converted len: {len(ys_converted)}')
-                n += 1
-                if n % 10 == 0:
-                    logging.debug(f'Iterating...n: {n}')
-                
-                # Check if setx has enough data for a batch
-                if len(setx) == cfg['batchSize']:
-                    logging.debug(f'yield batch, n: {n}')
-                    tx1 = np.array([item[0] for item in setx])
-                    ty1 = np.array([item[1] for item in setx])
-                    #print(f'tx1 shape: {tx1.shape}, ty1 shape: {ty1.shape}')
-                    last_batch = list(setx)
-                    setx = []
-                    yield tx1, ty1
-
-    train_dataset = tf.data.Dataset.from_generator(lambda: generator(train_books, True), output_signature=(
-        tf.TensorSpec(shape=(cfg['batchSize'], cfg['sequenceSize'], cfg['predictSteps']), dtype=tf.float32),
-        tf.TensorSpec(shape=(cfg['batchSize'], cfg['sequenceSize'], cfg['predictSteps']), dtype=tf.float32)
-    )).cache()
-    val_dataset = tf.data.Dataset.from_generator(lambda: generator(val_books, False), output_signature=(
-        tf.TensorSpec(shape=(cfg['batchSize'], cfg['sequenceSize'], cfg['predictSteps']), dtype=tf.float32),
-        tf.TensorSpec(shape=(cfg['batchSize'], cfg['sequenceSize'], cfg['predictSteps']), dtype=tf.float32)
-    )).cache()
-
-    train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-    val_dataset = val_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+    def log_background_validation():
+        for epoch_iter, val_loss in evaluator.poll():
+            logging.info(f"Validation Loss after iter {epoch_iter}: {val_loss}")
+            if wandb_log:
+                try:
+                    wandb.log({"iter": epoch_iter, "loss/val": val_loss})
+                except Exception as e:
+                    logging.error(f"logging to wandb failed: {e}")
 
 
     def on_epoch_end(epoch, logs):
         print("on_epoch_end")
         logging.debug('Starting on_epoch_end callback.')
-        # Calculate dt - the time taken for the epoch
-        dt = time.time() - time.epoch_start_time
-        # Estimate MFU
-        logging.debug("will estimate_mfu")
-        fwdbwd_per_iter = 1 # Assuming one forward and backward pass per iteration
-        # mfu = estimate_mfu(model, fwdbwd_per_iter, dt)
-
-        if not last_batch:
+
+        if not len(last_batch):
             logging.warning("last_batch is empty, skipping this epoch end.")
             return
-        model.save(model_path)
+        # weights and optimizer state are checkpointed in the background by CheckpointCallback
+        if epoch % cfg['exportEvery'] == 0:
+            export_model(model, model_path, is_chief)
+        if not is_chief:
+            return
 
         checkpoint_data['last_epoch'] = last_epoch + epoch
 
         with open(checkpoint_path, 'w') as file:
             json.dump(checkpoint_data, file)
 
-        r = random.randint(0, len(last_batch) - 1)
-        s = [last_batch[r]]
-        tx11 = np.array([item[0] for item in s])
+        if len(val_windows):
+            # the fixed validation windows, as evaluate() decodes, so the accuracy is not that of seen windows
+            samples = convert(val_windows[:cfg['decodeSamples']])
+            batch_x, batch_y, source = samples[:, :cfg['sequenceSize']], samples[:, cfg['predictSteps']:], 'validation'
+        else:
+            (batch_x, batch_y), source = last_batch, 'train'
+        tx11, predicted_tokens, real_tokens = decode_samples(model, batch_x, batch_y, cfg['decodeSamples'])
+        decode_accuracy = float(np.mean(predicted_tokens == real_tokens))
+        logging.info(f'Decoded {len(tx11)} {source} samples, token accuracy: {decode_accuracy}')
 
         show_test_output = epoch % 10 == 0
 
         if show_test_output:
-            res = model.predict(tx11)
-            a = res[0]
+            tokenizer = get_tokenizer()
             logging.info('---------------------------------INPUT-----------------------------------------')
-            logging.info(reparse(last_batch[r][0]))
+            logging.info(reparse(tx11[0]))
             logging.info('---------------------------------REAL-----------------------------------------')
-            logging.info(reparse(last_batch[r][1]))
+            logging.info(tokenizer.decode(real_tokens[0].tolist()))
             logging.info('--------------------------------PREDICT----------------------------------------')
-            logging.info(tokenizer.decode(list(map(lambda s: int(reverser(s)), a))))
+            logging.info(tokenizer.decode(predicted_tokens[0].tolist()))
+
+        train_loss = logs["loss"]
+        val_loss = None
+        if evaluator:
+            # reported by log_background_validation once the thread is done
+            evaluator.submit(model, last_epoch + epoch)
+            log_background_validation()
+        elif len(val_windows):
+            val_loss = evaluate_windows(model, val_windows, convert, cfg['sequenceSize'], cfg['predictSteps'],
+                                        cfg['valBatchSize'])
+        logging.info(f"Training Loss: {train_loss}, Validation Loss: {val_loss}")
 
         if wandb_log:
-            iters = 100
-            if cfg['batchSize'] >= 512:
-                iters = 10
-            logging.info(f'Will estimate loss for {iters} iters')
-            #train_loss = estimate_loss(model, train_dataset, iters/2)
-            train_loss = logs["loss"]
-            val_loss = estimate_loss(model, val_dataset, iters)
-            logging.info(f"Training Loss: {train_loss}, Validation Loss: {val_loss}")  
+            metrics = {
+                "iter": last_epoch + epoch,
+                "tokens": throughput.summary['total_tokens'],
+                "tokens_per_sec": throughput.summary['tokens_per_sec'],
+                "loss/train": train_loss,
+                "accuracy": logs["accuracy"],
+                "decode_accuracy": decode_accuracy,
+                "lr": cfg['learningRate'],
+                "mfu": throughput.summary['mfu'] * 100,  # convert to percentage
+            }
+            if val_loss is not None:
+                metrics["loss/val"] = val_loss
             try:
-                wandb.log(
-                    {
-                        "iter": last_epoch + epoch,
-                        "tokens": (last_epoch + epoch) * len(train_books) // 128,
-                        "loss/train": train_loss,
-                        "loss/val": val_loss, #logs["val_loss"],
-                        "accuracy": logs["accuracy"],
-                        "lr": learning_rate,
-                        "mfu": 0#mfu * 100,  # convert to percentage
-                    }
-                )
+                wandb.log(metrics)
             except Exception as e:
                 logging.error(f"logging to wandb failed: {e}")
     
-    num_batches_per_epoch = len(train_books) // cfg['batchSize']
-    steps_per_epoch=num_batches_per_epoch
     logging.info(f'steps_per_epoch: {steps_per_epoch}')
+    if steps_per_epoch == 0:
+        logging.error(f'Train books have {train_sampler.num_windows} windows, fewer than batchSize {cfg["batchSize"]}.')
+        return
     logging.debug('Starting model training.')
 
-    model.fit(train_dataset, epochs=len(train_books) // 128,
-              steps_per_epoch=steps_per_epoch, callbacks=[
-                    tf.keras.callbacks.LambdaCallback(
-        on_epoch_begin=lambda epoch, logs: setattr_time(time.time()),
-        on_epoch_end=on_epoch_end)
-    ], verbose = 2)
-
-run()
\ No newline at end of file
+    # runs before on_epoch_end below, so its summary is ready for wandb
+    # steps are in lockstep across workers, so tokens/sec and MFU are of the whole cluster
+    log_prefix = f'./logs/profile_{model_id}' + (f'_worker{worker_index}' if num_workers > 1 else '')
+    throughput = ThroughputCallback(profiler, cfg['batchSize'], cfg['sequenceSize'], cfg['peakFlops'] * num_workers,
+                                    log_prefix, initial_step)
+    callbacks = [throughput, tf.keras.callbacks.LambdaCallback(on_epoch_end=on_epoch_end)]
+    if is_chief:
+        callbacks.append(CheckpointCallback(checkpointer, checkpoint_state, cfg['checkpointEvery'], initial_step))
+
+    model.fit(train_dataset, epochs=epochs,
+              steps_per_epoch=steps_per_epoch, callbacks=callbacks, verbose = 2 if is_chief else 0)
+    if evaluator:
+        evaluator.wait()
+        log_background_validation()
+    export_model(model, model_path, is_chief)
+
+def evaluate():
+    """Validation loss and decode accuracy of the saved model of `cfg` on the fixed validation windows."""
+    model_path = model_paths(cfg)['model_path']
+    model = tf.keras.models.load_model(model_path, custom_objects={'TransformerLayer': TransformerLayer}, compile=False)
+    _, val_books = train_val_split()
+    val_windows = load_validation_windows(val_books)
+    if not len(val_windows):
+        logging.error('Validation books are too short for a single window.')
+        return None
+
+    val_loss = evaluate_windows(model, val_windows, convert, cfg['sequenceSize'], cfg['predictSteps'], cfg['valBatchSize'])
+    samples = convert(val_windows[:cfg['decodeSamples']])
+    _, predicted_tokens, real_tokens = decode_samples(model, samples[:, :cfg['sequenceSize']],
+                                                      samples[:, cfg['predictSteps']:], cfg['decodeSamples'])
+    return {'loss/val': val_loss, 'decode_accuracy': float(np.mean(predicted_tokens == real_tokens))}
+
+def quantize():
+    """
+    Export the saved model of `cfg` and the embedding table as int8 to `<model_path>_int8` and
+    compare the export with the float model on the fixed validation windows; the comparison
+    is written to report.json in the export and returned.
+    """
+    from quantization import QuantizedEmbeddingTable, accuracy_report, export_int8_model, load_int8_model, write_report
+    from vector_index import VectorIndex
+
+    model_path = model_paths(cfg)['model_path']
+    export_dir = model_path + '_int8'
+    model = tf.keras.models.load_model(model_path, custom_objects={'TransformerLayer': TransformerLayer}, compile=False)
+    export_int8_model(model, export_dir, get_embedding_table())
+    int8_model = load_int8_model(export_dir)
+    int8_table = QuantizedEmbeddingTable.load(os.path.join(export_dir, 'table.npz'))
+    int8_index = VectorIndex(int8_table.token_ids, int8_table.codes, mode=cfg['indexMode'], scales=int8_table.scales)
+
+    _, val_books = train_val_split()
+    val_windows = load_validation_windows(val_books)
+    report = accuracy_report(model, int8_model, val_windows, convert, cfg['sequenceSize'], cfg['predictSteps'],
+                             get_vector_index(), int8_index, cfg['valBatchSize'])
+    write_report(export_dir, report)
+    logging.info(f'Exported the int8 model to {export_dir}')
+    return report
+
+def generate(prompt, num_tokens, top_k=1, temperature=1.0, seed=None, int8=False):
+    from inference import InferenceEngine
+
+    model_path = model_paths(cfg)['model_path'] + ('_int8' if int8 else '')
+    engine = InferenceEngine(model_path, table_path=TABLE_PATH, vec_path=VEC_PATH, index_mode=cfg['indexMode'], int8=int8,
+                             vocab_path=VOCAB_PATH, tokens_dir=TOKENS_DIR)
+    return engine.generate_text(prompt, num_tokens, top_k=top_k, temperature=temperature, seed=seed)
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a cfg value, repeatable')
+    # seems to be better for M1 Macbook with the current architecture
+    common.add_argument('--cpu', action='store_true', help='hide the GPUs from TensorFlow')
+
+    parser = argparse.ArgumentParser(description='Train, evaluate and sample from the model.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    train_parser = commands.add_parser('train', parents=[common], help='train, resuming from the newest checkpoint')
+    train_parser.add_argument('--no-wandb', action='store_true')
+    train_parser.add_argument('--workers', type=int, default=1, help='data-parallel worker processes on this machine')
+    commands.add_parser('eval', parents=[common], help='validation loss and decode accuracy of the saved model')
+    generate_parser = commands.add_parser('generate', parents=[common], help='generate text with the saved model')
+    generate_parser.add_argument('--prompt', default='')
+    generate_parser.add_argument('--tokens', type=int, default=64)
+    generate_parser.add_argument('--top-k', type=int, default=1)
+    generate_parser.add_argument('--temperature', type=float, default=1.0)
+    generate_parser.add_argument('--seed', type=int, default=None)
+    generate_parser.add_argument('--int8', action='store_true', help='use the export of the quantize command')
+    commands.add_parser('quantize', parents=[common], help='export the saved model as int8 and report its accuracy')
+    # listed for --help only, its arguments are bench.py's and are passed on before parsing
+    commands.add_parser('bench', help='run bench.py, remaining arguments are passed to it')
+
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['bench']:
+        import bench
+        return bench.main(argv[1:])
+    # a bare `python train.py` trains, as it always did
+    args = parser.parse_args(argv or ['train'])
+
+    logging.basicConfig(level=logging.DEBUG if args.command == 'train' else logging.INFO)
+    if args.command == 'train' and args.workers > 1 and 'TF_CONFIG' not in os.environ:
+        # the workers run this same command line and find their place in TF_CONFIG
+        raise SystemExit(launch_local_workers(args.workers, argv))
+    try:
+        apply_overrides(cfg, args.set)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cpu:
+        tf.config.experimental.set_visible_devices([], 'GPU')
+
+    if args.command == 'train':
+        run(wandb_log=not args.no_wandb)
+    elif args.command == 'eval':
+        print(json.dumps(evaluate()))
+    elif args.command == 'generate':
+        text, stats = generate(args.prompt, args.tokens, top_k=args.top_k, temperature=args.temperature, seed=args.seed,
+                               int8=args.int8)
+        print(text)
+        print(f"{stats['forward_passes']} forward passes, {stats['tokens_per_sec']:.1f} tokens/sec")
+    elif args.command == 'quantize':
+        print(json.dumps(quantize()))
+
+if __name__ == "__main__":
+    main()
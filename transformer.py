@@ -0,0 +1,253 @@
+import logging
+
+import tensorflow as tf
+
+
+class TransformerLayer(tf.keras.layers.Layer):
+    """
+    Attention over the `pad_size` rows of the input with sigmoid*tanh gating.
+
+    With `fast=False` the layer runs the original implementation. With `fast=True` it skips
+    the all-ones mask and the per-call shape logging, projects query, key and value with one
+    fused matmul when `fused_qkv` is set, only applies dropout while training, and follows
+    the Keras mixed precision policy (fp32 variables, bf16/fp16 compute). `causal` and
+    `attention_mask` only cost anything when they are used.
+
+    With `recompute` the fast path keeps only its input for the backward pass while training
+    and runs the layer again to get the gradients (`tf.recompute_grad`), trading one more
+    forward pass for the memory of the attention activations.
+
+    `attention='chunked'` computes the attention of `chunk_size` query rows at a time, so the
+    (batch, heads, pad_size, pad_size) logits are never materialized, and recomputes every
+    chunk in the backward pass instead of keeping its weights. The gating is elementwise,
+    without a softmax over the row, so the chunks are exact, not an approximation. With
+    `causal` a chunk only multiplies the keys up to its last row. Chunking only pays off
+    when `pad_size` is well above `chunk_size`: `build_model` attends over `arrayDimension`
+    rows, 8 by default, where the single chunk just adds the recomputation.
+    """
+
+    def __init__(self, num_heads=8, pad_size=None, depth=None, pool=None, fast=False, fused_qkv=True,
+                 causal=False, recompute=False, attention='full', chunk_size=256, **kwargs):
+        super(TransformerLayer, self).__init__(**kwargs)
+        self.num_heads = num_heads
+        self.depth = depth
+        self.pool = pool
+        self.pad_size = pad_size
+        self.fast = fast
+        self.fused_qkv = fused_qkv
+        self.causal = causal
+        self.recompute = recompute
+        self.attention = attention
+        self.chunk_size = chunk_size
+        self.DEFAULT_KERNEL_INITIALIZER = "glorot_normal"
+        
+        if self.depth % self.num_heads != 0:
+            raise ValueError(f"Error: depth({self.depth}) % numHead({self.num_heads}) != 0")
+        if self.attention not in ('full', 'chunked'):
+            raise ValueError(f"Error: attention must be 'full' or 'chunked', not {self.attention!r}")
+
+    def build(self, input_shape):
+        input_feat_size = input_shape[-1]
+        
+        self.random_id_att = self.add_weight("random_id_att", shape=(1,), initializer=tf.initializers.Zeros())
+        self.random_id_ff = self.add_weight("random_id_ff", shape=(1,), initializer=tf.initializers.Zeros())
+        
+        # Define other weights
+        self.input_dense_weight = self.add_weight("input_dense_weight", shape=(input_feat_size, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.input_dense_bias = self.add_weight("input_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.query_dense_weight = self.add_weight("query_dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.query_dense_bias = self.add_weight("query_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.key_dense_weight = self.add_weight("key_dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.key_dense_bias = self.add_weight("key_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.value_dense_weight = self.add_weight("value_dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.value_dense_bias = self.add_weight("value_dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.dense_weight = self.add_weight("dense_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.dense_bias = self.add_weight("dense_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.ff_dense1_weight = self.add_weight("ff_dense1_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.ff_dense1_bias = self.add_weight("ff_dense1_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.ff_dense2_weight = self.add_weight("ff_dense2_weight", shape=(self.depth, self.depth), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        self.ff_dense2_bias = self.add_weight("ff_dense2_bias", shape=(self.depth,), initializer=self.DEFAULT_KERNEL_INITIALIZER)
+        
+        self.built = True
+
+    def call(self, inputs, attention_mask=None, training=None):
+        if self.fast and self.recompute and training:
+            return self._recomputed_call(inputs, attention_mask)
+        if self.fast:
+            return self._fast_call(inputs, attention_mask, training)
+        K = tf
+        # logging.debug(f"Shape of inputs: {inputs.shape}")
+        batch_size = tf.shape(inputs)[0]
+        
+        flat_input = tf.reshape(inputs, [self.pad_size * batch_size, -1])
+        flat_scaled_input = tf.matmul(flat_input, self.input_dense_weight) + self.input_dense_bias
+        scaled_input = tf.reshape(flat_scaled_input, [batch_size, self.pad_size, -1])
+        # logging.debug("Shape of scaledInput:", scaled_input.shape)
+
+        flat_query = tf.matmul(flat_scaled_input, self.query_dense_weight) + self.query_dense_bias
+        flat_key = tf.matmul(flat_scaled_input, self.key_dense_weight) + self.key_dense_bias
+        flat_value = tf.matmul(flat_scaled_input, self.value_dense_weight) + self.value_dense_bias
+
+        query = tf.reshape(flat_query, [batch_size, self.pad_size, -1])
+        key = tf.reshape(flat_key, [batch_size, self.pad_size, -1])
+        value = tf.reshape(flat_value, [batch_size, self.pad_size, -1])
+
+        query_t = tf.transpose(tf.reshape(query, [batch_size, -1, self.num_heads, self.depth // self.num_heads]), [0, 2, 1, 3])
+        key_t = tf.transpose(tf.reshape(key, [batch_size, -1, self.num_heads, self.depth // self.num_heads]), [0, 2, 1, 3])
+        value_t = tf.transpose(tf.reshape(value, [batch_size, -1, self.num_heads, self.depth // self.num_heads]), [0, 2, 1, 3])
+        logging.debug(f"Shape of queryT: {query_t.shape}")
+        logging.debug(f"Shape of keyT: {key_t.shape}")
+        logging.debug(f"Shape of valueT: {value_t.shape}")
+
+        matmul_qk = tf.matmul(query_t, key_t, transpose_b=True)
+        logits = matmul_qk / tf.sqrt(tf.cast(self.depth, matmul_qk.dtype))
+        logging.debug(f"Shape of logits before addition: {logits.shape}")
+        
+        to_broadcast_mask = tf.ones([batch_size, self.num_heads, self.pad_size, self.pad_size], dtype=logits.dtype)
+        logging.debug(f"Shape of to_broadcast_mask: {to_broadcast_mask.shape}")
+        logits += (1.0 - to_broadcast_mask) * -1e9
+
+        attention_weights = tf.nn.sigmoid(logits) * tf.nn.tanh(logits)
+        scaled_attention = tf.matmul(attention_weights, value_t)
+        
+        scaled_attention_t = tf.transpose(scaled_attention, [0, 2, 1, 3])
+        concat_attention = tf.reshape(scaled_attention_t, [batch_size, -1, self.depth])
+        flatten_concat_attention = tf.reshape(concat_attention, [batch_size * self.pad_size, -1])
+        flatten_attention = tf.matmul(flatten_concat_attention, self.dense_weight) + self.dense_bias
+        attention = tf.reshape(flatten_attention, [batch_size, self.pad_size, -1])
+        logging.debug(f"Shape of attention: {attention.shape}")
+
+        normalized_latent = scaled_input + tf.squeeze(self.random_id_att) * attention
+        flatten_normalized_latent = tf.reshape(normalized_latent, [batch_size * self.pad_size, -1])
+        
+        flat_ff1 = tf.matmul(flatten_normalized_latent, self.ff_dense1_weight) + self.ff_dense1_bias
+        flat_rff1 = tf.nn.leaky_relu(flat_ff1)
+        flat_ff2 = tf.matmul(flat_rff1, self.ff_dense2_weight) + self.ff_dense2_bias
+        flat_dff2 = tf.nn.dropout(flat_ff2, 0.1)
+        dff2 = tf.reshape(flat_dff2, [batch_size, self.pad_size, -1])
+
+        output = normalized_latent + tf.squeeze(self.random_id_ff) * dff2
+        output = tf.reshape(output, [batch_size, self.pad_size, self.depth])
+        logging.debug("Return output")
+        if self.pool:
+            return tf.reduce_mean(output, axis=1)
+        else:
+            return output
+
+
+    def _recomputed_call(self, inputs, attention_mask):
+        # the dropout mask must be the same when the forward pass runs again for the
+        # gradients, so it comes from a seed drawn outside the recomputed function
+        seed = tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+
+        @tf.recompute_grad
+        def forward(inputs):
+            return self._fast_call(inputs, attention_mask, training=True, dropout_seed=seed)
+
+        return forward(inputs)
+
+    def _fast_call(self, inputs, attention_mask, training, dropout_seed=None):
+        batch_size = tf.shape(inputs)[0]
+        head_depth = self.depth // self.num_heads
+
+        flat_input = tf.reshape(inputs, [batch_size * self.pad_size, -1])
+        flat_scaled_input = tf.matmul(flat_input, self.input_dense_weight) + self.input_dense_bias
+        scaled_input = tf.reshape(flat_scaled_input, [batch_size, self.pad_size, self.depth])
+
+        def heads(flat):
+            return tf.transpose(tf.reshape(flat, [batch_size, self.pad_size, self.num_heads, head_depth]), [0, 2, 1, 3])
+
+        if self.fused_qkv:
+            qkv_weight = tf.concat([self.query_dense_weight, self.key_dense_weight, self.value_dense_weight], axis=1)
+            qkv_bias = tf.concat([self.query_dense_bias, self.key_dense_bias, self.value_dense_bias], axis=0)
+            flat_query, flat_key, flat_value = tf.split(tf.matmul(flat_scaled_input, qkv_weight) + qkv_bias, 3, axis=1)
+        else:
+            flat_query = tf.matmul(flat_scaled_input, self.query_dense_weight) + self.query_dense_bias
+            flat_key = tf.matmul(flat_scaled_input, self.key_dense_weight) + self.key_dense_bias
+            flat_value = tf.matmul(flat_scaled_input, self.value_dense_weight) + self.value_dense_bias
+        query_t, key_t, value_t = heads(flat_query), heads(flat_key), heads(flat_value)
+
+        if self.attention == 'chunked' and self.chunk_size < self.pad_size:
+            scaled_attention = self._chunked_attention(query_t, key_t, value_t, attention_mask, training)
+        else:
+            logits = tf.matmul(query_t, key_t, transpose_b=True) * (1.0 / self.depth ** 0.5)
+            logits = self._mask_logits(logits, attention_mask)
+            attention_weights = tf.nn.sigmoid(logits) * tf.nn.tanh(logits)
+            scaled_attention = tf.matmul(attention_weights, value_t)
+        flatten_concat_attention = tf.reshape(tf.transpose(scaled_attention, [0, 2, 1, 3]), [batch_size * self.pad_size, self.depth])
+        flatten_attention = tf.matmul(flatten_concat_attention, self.dense_weight) + self.dense_bias
+
+        flatten_normalized_latent = flat_scaled_input + tf.squeeze(self.random_id_att) * flatten_attention
+        flat_ff1 = tf.matmul(flatten_normalized_latent, self.ff_dense1_weight) + self.ff_dense1_bias
+        flat_rff1 = tf.nn.leaky_relu(flat_ff1)
+        flat_ff2 = tf.matmul(flat_rff1, self.ff_dense2_weight) + self.ff_dense2_bias
+        if training and dropout_seed is not None:
+            flat_ff2 = tf.nn.experimental.stateless_dropout(flat_ff2, 0.1, seed=dropout_seed)
+        elif training:
+            flat_ff2 = tf.nn.dropout(flat_ff2, 0.1)
+
+        flat_output = flatten_normalized_latent + tf.squeeze(self.random_id_ff) * flat_ff2
+        output = tf.reshape(flat_output, [batch_size, self.pad_size, self.depth])
+        if self.pool:
+            return tf.reduce_mean(output, axis=1)
+        return output
+
+    def _chunked_attention(self, query_t, key_t, value_t, attention_mask, training):
+        """Attention of (batch, heads, pad_size, head_depth) heads, `chunk_size` query rows at a time."""
+        scale = 1.0 / self.depth ** 0.5
+        chunks = []
+        for start in range(0, self.pad_size, self.chunk_size):
+            end = min(start + self.chunk_size, self.pad_size)
+            keys = end if self.causal else self.pad_size
+            mask = None if attention_mask is None else attention_mask[:, :keys]
+
+            def chunk(query, key, value, start=start, end=end, mask=mask):
+                logits = tf.matmul(query, key, transpose_b=True) * scale
+                logits = self._mask_logits(logits, mask, start, end)
+                return tf.matmul(tf.nn.sigmoid(logits) * tf.nn.tanh(logits), value)
+
+            if training:
+                chunk = tf.recompute_grad(chunk)
+            chunks.append(chunk(query_t[:, :, start:end], key_t[:, :, :keys], value_t[:, :, :keys]))
+        return tf.concat(chunks, axis=2)
+
+    def _mask_logits(self, logits, attention_mask, row_start=0, row_end=None):
+        """
+        Push masked logits to the most negative value of the compute dtype, where
+        sigmoid(x) * tanh(x) is zero. Returns `logits` untouched when nothing is masked.
+        `logits` are those of the query rows [row_start, row_end) against the first
+        `logits.shape[-1]` keys.
+        """
+        keep = None
+        if self.causal:
+            rows = tf.range(row_start, self.pad_size if row_end is None else row_end)[:, tf.newaxis]
+            keep = rows >= tf.range(tf.shape(logits)[-1])[tf.newaxis, :]
+        if attention_mask is not None:
+            # attention_mask: (batch, keys), true/1 for rows that may be attended to
+            padding = tf.cast(attention_mask, tf.bool)[:, tf.newaxis, tf.newaxis, :]
+            keep = padding if keep is None else tf.logical_and(keep, padding)
+        if keep is None:
+            return logits
+        return tf.where(keep, logits, tf.cast(logits.dtype.min, logits.dtype))
+
+    def compute_output_shape(self, input_shape):
+        if self.pool:
+            return (input_shape[0], self.depth)
+        else:
+            return (input_shape[0], input_shape[1], self.depth)
+
+    def get_config(self):
+        config = super(TransformerLayer, self).get_config()
+        config.update({
+            'pool': self.pool,
+            'pad_size': self.pad_size,
+            'num_heads': self.num_heads,
+            'depth': self.depth,
+            'fast': self.fast,
+            'fused_qkv': self.fused_qkv,
+            'causal': self.causal,
+            'recompute': self.recompute,
+            'attention': self.attention,
+            'chunk_size': self.chunk_size
+        })
+        return config
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import queue
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from sampler import WindowSampler
+from token_store import TOKEN_DTYPE
+
+
+def validation_key(books, book_hashes, cfg):
+    """Hash of everything that selects the validation windows, used as their cache entry hash."""
+    spec = {'books': sorted(zip(books, book_hashes)), 'windows': cfg['valWindows'], 'seed': cfg['shuffleSeed'],
+            'stride': cfg['windowStride'], 'format': 'tokens'}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def sample_validation_windows(book_tokens, sequence_size, predict_steps, num_windows, stride=1, seed=0):
+    """
+    Draw `num_windows` windows once from the token ids of the validation books into one
+    (windows, sequence_size + predict_steps) uint32 array, embedded batch by batch when they
+    are evaluated; the input of a window is `[:, :sequence_size]` and its target `[:, predict_steps:]`.
+    """
+    sampler = WindowSampler([len(t) for t in book_tokens], sequence_size, predict_steps, batch_size=1,
+                            stride=stride, seed=seed)
+    # sorted, so windows of the same book are read together
+    window_ids = np.sort(sampler.epoch_order(0)[:num_windows])
+    books, starts = sampler.locate(window_ids)
+    spans = np.empty((len(books), sequence_size + predict_steps), dtype=TOKEN_DTYPE)
+    positions = np.arange(sequence_size + predict_steps)
+    for book in np.unique(books):
+        rows = np.flatnonzero(books == book)
+        spans[rows] = np.asarray(book_tokens[book])[starts[rows, None] + positions]
+    return spans
+
+
+def huber_loss(targets, predictions, delta=1.0):
+    """
+    Mean Huber loss over all elements, the value of `tf.keras.losses.Huber(delta)`.
+
+    Computed in NumPy, because a Keras loss with the default reduction raises when it is
+    called inside a distribution strategy, e.g. from a callback of a multi-worker `fit`.
+    """
+    error = np.abs(np.asarray(predictions, dtype=np.float32) - np.asarray(targets, dtype=np.float32))
+    quadratic = np.minimum(error, delta)
+    return float(np.mean(0.5 * quadratic ** 2 + delta * (error - quadratic)))
+
+
+def evaluate_windows(model, windows, embed, sequence_size, predict_steps, batch_size=512):
+    """
+    Mean Huber loss of `model` over fixed validation windows of token ids, embedded with
+    `embed` (token ids -> vectors) in batches of `batch_size`.
+    """
+    total = 0.0
+    for start in range(0, len(windows), batch_size):
+        chunk = embed(windows[start:start + batch_size])
+        predictions = model(chunk[:, :sequence_size], training=False).numpy()
+        total += huber_loss(chunk[:, predict_steps:], predictions) * len(chunk)
+    return total / max(1, len(windows))
+
+
+class BackgroundEvaluator:
+    """
+    Evaluates weight snapshots on the validation windows in a thread, overlapped with training.
+
+    `submit` copies the weights into a clone of the model that only the thread uses; while
+    one evaluation is still queued, the next `submit` waits for it, so validation never
+    falls more than one snapshot behind. Finished results are collected with `poll`.
+    """
+
+    def __init__(self, model, windows, embed, sequence_size, predict_steps, batch_size=512):
+        self.model = tf.keras.models.clone_model(model)
+        self.windows = windows
+        self.embed = embed
+        self.sequence_size = sequence_size
+        self.predict_steps = predict_steps
+        self.batch_size = batch_size
+        self.pending = queue.Queue(maxsize=1)
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, model, tag):
+        self.pending.put((tag, model.get_weights()))
+
+    def _loop(self):
+        while True:
+            tag, weights = self.pending.get()
+            try:
+                self.model.set_weights(weights)
+                self.results.put((tag, evaluate_windows(self.model, self.windows, self.embed, self.sequence_size,
+                                                        self.predict_steps, self.batch_size)))
+            except Exception as e:
+                logging.error(f"Background validation of {tag} failed: {e}")
+            finally:
+                self.pending.task_done()
+
+    def poll(self):
+        """(tag, loss) of every evaluation finished since the last call."""
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def wait(self):
+        self.pending.join()
@@ -0,0 +1,185 @@
+import logging
+
+import numpy as np
+
+from embedding_table import load_vec_file
+
+
+class VectorIndex:
+    """
+    Nearest-neighbour index that maps predicted vectors back to token ids.
+
+    The table is built once and every query is answered in batches, so decoding
+    a (batch, seq, dim) prediction tensor is a handful of matrix products instead
+    of one full table scan per token.
+
+    Args:
+    - token_ids (np.ndarray): Token id of every row in `vectors`.
+    - vectors (np.ndarray): Embedding table of shape (rows, dim).
+    - mode (str): 'exact' for a brute-force search, 'ivf' for a partitioned search
+      over `num_partitions` k-means cells of which `num_probe` are scanned.
+    - quantize (bool): Keep only int8 codes with per-row scales of the table and search
+      them directly, a quarter of the memory and memory traffic of the float table.
+    - scales (np.ndarray): Per-row scales when `vectors` already holds int8 codes, e.g. of
+      a `QuantizedEmbeddingTable`; implies `quantize`.
+    """
+
+    # bytes of the (queries, rows) distance block of the exact search; the table is scanned in
+    # blocks of rows that fit, so the peak memory does not grow with the table
+    SEARCH_BLOCK_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, token_ids, vectors, mode='exact', num_partitions=None, num_probe=4,
+                 quantize=False, chunk_size=4096, seed=0, scales=None):
+        if mode not in ('exact', 'ivf'):
+            raise ValueError(f"Error: unknown index mode {mode}")
+        self.token_ids = np.asarray(token_ids, dtype=np.int64)
+        self.mode = mode
+        self.quantize = quantize or scales is not None
+        self.chunk_size = chunk_size
+
+        if scales is not None:
+            self.codes = np.ascontiguousarray(vectors, dtype=np.int8)
+            self.scales = np.asarray(scales, dtype=np.float32)
+        elif quantize:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            self.scales = np.abs(vectors).max(axis=1) / 127.0
+            self.scales[self.scales == 0] = 1.0
+            self.codes = np.round(vectors / self.scales[:, None]).astype(np.int8)
+        else:
+            self.search_table = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.num_rows, self.dim = (self.codes if self.quantize else self.search_table).shape
+        if self.quantize:
+            codes = self.codes.astype(np.float32)
+            self.search_norms = np.einsum('ij,ij->i', codes, codes) * self.scales ** 2
+        else:
+            self.search_norms = np.einsum('ij,ij->i', self.search_table, self.search_table)
+
+        if mode == 'ivf':
+            if num_partitions is None:
+                num_partitions = max(1, int(np.sqrt(self.num_rows)))
+            self.num_probe = min(num_probe, num_partitions)
+            self._build_partitions(num_partitions, seed)
+
+    def _table_rows(self, rows):
+        """Float32 search table rows, dequantized from the int8 codes if quantized."""
+        if self.quantize:
+            return self.codes[rows].astype(np.float32) * self.scales[rows][:, None]
+        return self.search_table[rows]
+
+    @classmethod
+    def from_vec_file(cls, vec_path, **kwargs):
+        token_ids, vectors = load_vec_file(vec_path)
+        logging.info(f"Built vector index from {vec_path}: {len(token_ids)} tokens, dim {vectors.shape[1]}")
+        return cls(token_ids, vectors, **kwargs)
+
+    @classmethod
+    def from_table(cls, table, **kwargs):
+        token_ids = table.token_ids
+        return cls(token_ids, table.gather(token_ids), **kwargs)
+
+    def _build_partitions(self, num_partitions, seed, iterations=10):
+        rng = np.random.default_rng(seed)
+        table = self._table_rows(np.arange(self.num_rows))
+        centroids = table[rng.choice(len(table), size=num_partitions, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = self._nearest(table, centroids)
+            for c in range(num_partitions):
+                members = table[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        assignment = self._nearest(table, centroids)
+        order = np.argsort(assignment, kind='stable')
+        self.centroids = centroids
+        self.partition_rows = order
+        self.partition_bounds = np.searchsorted(assignment[order], np.arange(num_partitions + 1))
+
+    def _nearest(self, queries, table, table_norms=None):
+        if table_norms is None:
+            table_norms = np.einsum('ij,ij->i', table, table)
+        best = np.empty(len(queries), dtype=np.int64)
+        for start in range(0, len(queries), self.chunk_size):
+            q = queries[start:start + self.chunk_size]
+            # |q - t|^2 = |q|^2 - 2 q.t + |t|^2, |q|^2 does not change the argmin
+            distances = table_norms[None, :] - 2.0 * (q @ table.T)
+            best[start:start + self.chunk_size] = np.argmin(distances, axis=1)
+        return best
+
+    def _search_blocks(self, q, k):
+        """
+        Exact top-k of the table, one block of rows (dequantized if the table is int8) at a
+        time, keeping a running top-k so a block of distances is all that is materialized.
+        """
+        block_rows = max(k, self.SEARCH_BLOCK_BYTES // (4 * max(1, len(q))))
+        best_rows = best_d = None
+        for start in range(0, self.num_rows, block_rows):
+            end = min(start + block_rows, self.num_rows)
+            block = self._table_rows(slice(start, end))
+            d = self.search_norms[None, start:end] - 2.0 * (q @ block.T)
+            top, top_d = self._top_k(d, k)
+            top += start
+            if best_rows is not None:
+                # earlier blocks come first, so ties keep the lowest row as in a single scan
+                top, top_d = np.concatenate([best_rows, top], axis=1), np.concatenate([best_d, top_d], axis=1)
+                keep, top_d = self._top_k(top_d, k)
+                top = np.take_along_axis(top, keep, axis=1)
+            best_rows, best_d = top, top_d
+        return best_rows, best_d
+
+    def _search_rows(self, queries, k):
+        k = min(k, self.num_rows)
+        if self.mode == 'exact':
+            rows = np.empty((len(queries), k), dtype=np.int64)
+            distances = np.empty((len(queries), k), dtype=np.float32)
+            for start in range(0, len(queries), self.chunk_size):
+                q = queries[start:start + self.chunk_size]
+                rows[start:start + len(q)], distances[start:start + len(q)] = self._search_blocks(q, k)
+            return rows, distances + np.einsum('ij,ij->i', queries, queries)[:, None]
+
+        centroid_d = np.einsum('ij,ij->i', self.centroids, self.centroids)[None, :] - 2.0 * (queries @ self.centroids.T)
+        probes = np.argsort(centroid_d, axis=1)[:, :self.num_probe]
+        rows = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        # group the queries by their probe set so every group is one matrix product
+        probe_keys, inverse = np.unique(np.sort(probes, axis=1), axis=0, return_inverse=True)
+        for group, cells in enumerate(probe_keys):
+            members = np.flatnonzero(inverse.ravel() == group)
+            candidates = np.concatenate([self.partition_rows[self.partition_bounds[c]:self.partition_bounds[c + 1]] for c in cells])
+            table = self._table_rows(candidates)
+            q = queries[members]
+            d = self.search_norms[candidates][None, :] - 2.0 * (q @ table.T)
+            top, top_d = self._top_k(d, k)
+            # a probed cell set smaller than k repeats its farthest candidate
+            pad = k - top.shape[1]
+            rows[members] = np.pad(candidates[top], ((0, 0), (0, pad)), mode='edge')
+            distances[members] = np.pad(top_d, ((0, 0), (0, pad)), mode='edge')
+        return rows, distances + np.einsum('ij,ij->i', queries, queries)[:, None]
+
+    @staticmethod
+    def _top_k(distances, k):
+        k = min(k, distances.shape[1])
+        if k == 1:
+            top = np.argmin(distances, axis=1)[:, None]
+        else:
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(distances, top, axis=1), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+        return top, np.take_along_axis(distances, top, axis=1)
+
+    def search(self, predictions, k=1):
+        """
+        Return the `k` nearest token ids and squared distances for every vector.
+
+        `predictions` may have any leading shape, e.g. (batch, seq, dim); the results
+        have shape (*leading, k).
+        """
+        predictions = np.asarray(predictions, dtype=np.float32)
+        leading = predictions.shape[:-1]
+        queries = predictions.reshape(-1, self.dim)
+        rows, distances = self._search_rows(queries, k)
+        k = rows.shape[1]
+        return self.token_ids[rows].reshape(*leading, k), distances.reshape(*leading, k)
+
+    def decode(self, predictions):
+        """Map every vector of `predictions` to its nearest token id."""
+        token_ids, _ = self.search(predictions, k=1)
+        return token_ids[..., 0]
@@ -0,0 +1,156 @@
+"""
+Compact embedding table of the tokens the training corpus actually uses.
+
+The fastText table holds a vector for every token fastText saw, indexed by token id up to
+the largest id. `VocabTable` keeps only the tokens of the token store, as dense rows in
+token id order, plus row 0 for the tokens without a vector (OOV), and the number of
+occurrences of every row in the corpus. Conversion gathers rows through an id -> row map,
+and the vector index searches just these rows.
+
+    models/vocab.npz          the table, rebuilt when vec.bin or the token store changes
+    models/vocab_report.json  coverage of the corpus by the fastText vectors
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+OOV_ROW = 0
+REPORT_FILE = 'vocab_report.json'
+
+
+class VocabTable:
+    """
+    Dense token table with an explicit OOV row, with the lookup interface of `EmbeddingTable`
+    (`gather`, `contains`, `token_ids`, `dim`, `rows`).
+
+    Args:
+    - token_ids (np.ndarray): Token id of every row, -1 for the OOV row 0.
+    - vectors (np.ndarray): (rows, dim) vectors, row 0 is used for every OOV token.
+    - counts (np.ndarray): Occurrences of every row in the corpus.
+    - source (str): Fingerprint of the table and corpus the vocabulary was built from.
+    """
+
+    def __init__(self, token_ids, vectors, counts, source=''):
+        self.row_ids = np.asarray(token_ids, dtype=np.int64)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.source = str(source)
+        self.dim = self.vectors.shape[1]
+        self.rows = int(self.row_ids.max()) + 1 if len(self.row_ids) > 1 else 0
+        self.row_of = np.full(self.rows, OOV_ROW, dtype=np.int32)
+        self.row_of[self.row_ids[1:]] = np.arange(1, len(self.row_ids), dtype=np.int32)
+        self.empty_vec = self.vectors[OOV_ROW]
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['token_ids'], data['vectors'], data['counts'], data['source'])
+
+    def save(self, path):
+        # through a temporary file, so readers never see a half-written table
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, token_ids=self.row_ids, vectors=self.vectors, counts=self.counts, source=self.source)
+        os.replace(path + '.tmp', path)
+
+    @property
+    def token_ids(self):
+        """Token ids with a vector, without the OOV row."""
+        return self.row_ids[1:]
+
+    def rows_of(self, token_ids):
+        """Row of every token id, `OOV_ROW` for tokens outside the vocabulary."""
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        in_range = (token_ids >= 0) & (token_ids < self.rows)
+        return np.where(in_range, self.row_of[np.where(in_range, token_ids, 0)], OOV_ROW)
+
+    def contains(self, token_ids):
+        return self.rows_of(token_ids) != OOV_ROW
+
+    def gather(self, token_ids):
+        """Vectors of shape (*shape, dim); tokens outside the vocabulary get the OOV vector."""
+        return self.vectors[self.rows_of(token_ids)]
+
+
+def vocab_source(table, store):
+    """Fingerprint of the fastText table file and the deduplicated books of the token store."""
+    stat = os.stat(table.path)
+    books = [[book, entry['hash'], entry.get('keep')] for book, entry in sorted(store.books.items())]
+    return hashlib.sha1(json.dumps([stat.st_size, stat.st_mtime_ns, books]).encode()).hexdigest()
+
+
+def build_vocab_table(table, store, source=''):
+    """
+    Count the tokens of every book of `store` and keep the rows of `table` that occur.
+
+    Returns the `VocabTable` and a coverage report: corpus tokens, how many of them and of
+    the distinct tokens have no vector, the most frequent of those and the books they are in.
+    """
+    counts = np.zeros(table.rows, dtype=np.int64)
+    book_oov = {}
+    for book in sorted(store.books):
+        tokens = store.get_kept(book)
+        book_counts = np.bincount(tokens, minlength=len(counts)) if len(tokens) else np.zeros(0, dtype=np.int64)
+        if len(book_counts) > len(counts):
+            counts = np.concatenate([counts, np.zeros(len(book_counts) - len(counts), dtype=np.int64)])
+        counts[:len(book_counts)] += book_counts
+        missing = int(np.sum(~table.contains(tokens))) if len(tokens) else 0
+        if missing:
+            book_oov[book] = missing
+
+    used = np.flatnonzero(counts)
+    present = table.contains(used)
+    vocab_ids, oov_ids = used[present], used[~present]
+    oov_count = int(counts[oov_ids].sum())
+    vocab = VocabTable(
+        np.concatenate([[-1], vocab_ids]),
+        np.concatenate([np.zeros((1, table.dim), dtype=np.float32), table.gather(vocab_ids)]),
+        np.concatenate([[oov_count], counts[vocab_ids]]),
+        source)
+
+    total = int(counts.sum())
+    top_oov = oov_ids[np.argsort(-counts[oov_ids], kind='stable')[:20]]
+    report = {
+        'corpus_tokens': total,
+        'distinct_tokens': len(used),
+        'table_tokens': len(table.token_ids),
+        'vocab_tokens': len(vocab_ids),
+        'oov_tokens': oov_count,
+        'oov_distinct': len(oov_ids),
+        'coverage': 1.0 - oov_count / max(1, total),
+        'top_oov': [[int(token), int(counts[token])] for token in top_oov],
+        'books_with_oov': dict(sorted(book_oov.items(), key=lambda item: -item[1])[:20]),
+    }
+    return vocab, report
+
+
+def save_vocab_table(path, table, store):
+    """Build the vocabulary of `table` over `store`, save it to `path` and its coverage report next to it."""
+    vocab, report = build_vocab_table(table, store, vocab_source(table, store))
+    vocab.save(path)
+    with open(os.path.join(os.path.dirname(path), REPORT_FILE), 'w') as f:
+        json.dump(report, f, indent=1)
+    return vocab, report
+
+
+def load_vocab_table(path, table, store):
+    """
+    Open the vocabulary of `table` over the books of `store`, building it first if it is
+    missing or was built from another table or corpus. Returns `table` itself when the
+    store has no books to build it from.
+    """
+    if not store.books:
+        logging.warning(f"No tokenized books in {store.store_dir}, using the full embedding table")
+        return table
+    if os.path.exists(path):
+        vocab = VocabTable.load(path)
+        if vocab.source == vocab_source(table, store):
+            return vocab
+    vocab, report = save_vocab_table(path, table, store)
+    logging.info(f"Vocabulary of {report['vocab_tokens']} of {report['table_tokens']} table tokens saved to {path}, "
+                 f"coverage {report['coverage']:.4%}, {report['oov_tokens']} OOV tokens of {report['oov_distinct']} ids")
+    if report['oov_tokens']:
+        logging.warning(f"Tokens without a vector, by count: {report['top_oov'][:10]}")
+    return vocab